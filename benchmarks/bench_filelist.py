@@ -0,0 +1,145 @@
+#!/usr/bin/env python3
+# Copyright 2019-2020 Jiří Janoušek <janousek.jiri@gmail.com>
+# License: BSD-2-Clause, see file LICENSE at the project root.
+"""
+Benchmark filelist rule matching on synthetic `/app` trees.
+
+Usage: benchmarks/bench_filelist.py [SIZE...]
+
+Each tree is populated by synthetic modules installing libraries, headers, data files and translations.
+The rules mirror the shape of real `x-stage`/`x-keep` sets: exact paths, brace groups, `@` optional patterns and deep
+wildcards. Note that the page cache is warm for the walk because the tree has just been created.
+"""
+import importlib.util
+import os
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import Callable, List, Tuple, TypeVar
+
+T = TypeVar("T")
+SIZES = (10_000, 100_000, 1_000_000)
+MODULES = 60
+LOCALES = ("cs", "de", "en_GB", "es", "fr", "ja", "pt_BR", "ru", "zh_CN")
+
+_spec = importlib.util.spec_from_file_location(
+    "filelist", Path(__file__).resolve().parent.parent / "nufb" / "data" / "filelist.py"
+)
+filelist = importlib.util.module_from_spec(_spec)
+_spec.loader.exec_module(filelist)  # type: ignore
+
+
+def module_files(root: str, module: str, count: int) -> List[str]:
+    files = [
+        f"{root}/bin/{module}",
+        f"{root}/bin/{module}-tool",
+        f"{root}/lib/lib{module}-1.0.so",
+        f"{root}/lib/lib{module}-1.0.so.0",
+        f"{root}/lib/pkgconfig/{module}-1.0.pc",
+        f"{root}/share/man/man1/{module}.1",
+    ]
+    index = 0
+    while len(files) < count:
+        kind = index % 4
+        if kind == 0:
+            files.append(f"{root}/include/{module}-1.0/{module}/sub{index % 7}/header{index}.h")
+        elif kind == 1:
+            files.append(f"{root}/share/{module}/data/{index % 11}/{index % 5}/file{index}.dat")
+        elif kind == 2:
+            files.append(f"{root}/share/locale/{LOCALES[index % len(LOCALES)]}/LC_MESSAGES/{module}-{index}.mo")
+        else:
+            files.append(f"{root}/lib/debug/lib/lib{module}-1.0.so.0.{index}.debug")
+        index += 1
+    return files
+
+
+def module_rules(root: str, module: str) -> Tuple[List[str], List[str]]:
+    stage = [
+        f"{root}/include/{module}-1.0/*",
+        f"{root}/lib/pkgconfig/{module}-1.0.pc",
+        f"@{root}/share/man/*/{module}.*",
+    ]
+    keep = [
+        f"{root}/bin/{module}{{,-tool}}",
+        f"{root}/lib/lib{module}-1.0.so*",
+        f"{root}/share/{module}/*",
+        f"{root}/share/locale/*/LC_MESSAGES/{module}-*.mo",
+        f"@{root}/share/{{doc,gtk-doc}}/{module}/*",
+    ]
+    return stage, keep
+
+
+def build_tree(directory: str, size: int) -> Tuple[str, List[str]]:
+    """
+    Create a synthetic tree and the rule files.
+
+    :return: The root of the tree and the rule files (one stage file per module and a final keep file).
+    """
+    root = os.path.join(directory, "app")
+    rules_dir = os.path.join(directory, "rules")
+    os.makedirs(rules_dir)
+    keep_files = [f"{root}/lib/debug/*"]
+    rule_files = []
+
+    for module_index in range(MODULES):
+        module = f"module{module_index}"
+        count = size // MODULES + (module_index < size % MODULES)
+        for path in module_files(root, module, count):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, "w"):
+                pass
+
+        stage, keep = module_rules(root, module)
+        keep_files.append(f"# module: {module}")
+        keep_files += keep
+        rule_file = os.path.join(rules_dir, module)
+        with open(rule_file, "w") as f:
+            f.write("\n".join(stage + keep + [f"@{root}/lib/debug/*"]) + "\n")
+        rule_files.append(rule_file)
+
+    rule_file = os.path.join(rules_dir, "keep")
+    with open(rule_file, "w") as f:
+        f.write("\n".join(keep_files) + "\n")
+    rule_files.append(rule_file)
+    return root, rule_files
+
+
+def measure(func: Callable[[], T]) -> Tuple[T, float]:
+    start = time.perf_counter()
+    result = func()
+    return result, time.perf_counter() - start
+
+
+def run(size: int) -> None:
+    with tempfile.TemporaryDirectory(prefix="nufb-bench-") as directory:
+        (root, rule_files), elapsed = measure(lambda: build_tree(directory, size))
+        print(f"{size} entries, {len(rule_files) - 1} modules, tree built in {elapsed:.1f} s")
+
+        entries, elapsed = measure(lambda: filelist.collect_entries(root))
+        report("collect_entries", len(entries), elapsed)
+
+        patterns = filelist.PatternMatcher()
+        paths: set = set()
+        _, elapsed = measure(lambda: [filelist.read_rules(paths, patterns, file) for file in rule_files])
+        report("read_rules", len(patterns) + len(paths), elapsed, "rules")
+
+        extra, elapsed = measure(lambda: filelist.process_entries(paths, patterns, entries))
+        report("process_entries", len(entries), elapsed)
+        assert not extra, extra[:10]
+
+
+def report(name: str, count: int, elapsed: float, unit: str = "entries") -> None:
+    rate = count / elapsed if elapsed else float("inf")
+    print(f"  {name:<16} {elapsed:8.3f} s {rate:14,.0f} {unit}/s")
+
+
+def main(argv: List[str]) -> int:
+    sizes = [int(size) for size in argv[1:]] or SIZES
+    for size in sizes:
+        run(size)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
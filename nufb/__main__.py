@@ -1,14 +1,33 @@
 import asyncio
+import os
 import sys
 from pathlib import Path
+from typing import Any, Awaitable, Callable, TypeVar
 
 import clizy
 
 import nufb
-from nufb import utils
-from nufb.builder import build_adk, build_all, build_app, build_apps, build_base, build_cdk, build_nuvola
+from nufb import metrics
+from nufb.builder import (
+    APP_MANIFEST,
+    BuildSession,
+    build_all,
+    build_apps,
+    get_app_subst,
+    get_export_mode,
+    load_config,
+    plan_all,
+    update_app_mirrors,
+)
+from nufb.history import format_plan
 from nufb.logging import init_logging
+from nufb.metrics import enable_metrics
+from nufb.publish import publish_repo
+from nufb.report import format_size_report, load_size_report
 from nufb.repo import update_repo, prune_repo
+from nufb.tracing import enable_tracing, save_trace
+
+T = TypeVar("T")
 
 
 def main() -> int:
@@ -18,21 +37,46 @@ def main() -> int:
         sys.argv[0] = "nufbctl"
 
     init_logging()
-    clizy.run_funcs(
-        buildall,
-        buildcdk,
-        buildadk,
-        buildbase,
-        buildnuvola,
-        buildapp,
-        buildapps,
-        updaterepo,
-        prunerepo,
-        version,
-    )
+    metrics_file = os.environ.get("NUFB_METRICS_FILE")
+    if metrics_file:
+        enable_metrics(Path(metrics_file))
+    try:
+        clizy.run_funcs(
+            buildall,
+            buildcdk,
+            buildadk,
+            buildbase,
+            buildnuvola,
+            buildapp,
+            buildapps,
+            mirrorapps,
+            plan,
+            updaterepo,
+            prunerepo,
+            publish,
+            sizes,
+            version,
+        )
+    finally:
+        metrics.flush()
     return 0
 
 
+def run_session(func: Callable[[BuildSession], Awaitable[T]], **kwargs: Any) -> T:
+    """
+    Create a build session and run a function with it in a new event loop.
+
+    :param func: The function to run.
+    :param kwargs: Parameters of :class:`BuildSession`.
+    :return: The result of the function.
+    """
+
+    async def run() -> T:
+        return await func(await BuildSession.create(**kwargs))
+
+    return asyncio.run(run())
+
+
 def version() -> None:
     """Print version."""
     print("nufb", nufb.__version__)
@@ -46,14 +90,11 @@ def buildcdk(
     keep_build_dirs: bool = False,
     delete_build_dirs: bool = False,
 ):
-    asyncio.run(
-        build_cdk(
-            branch,
-            no_export=no_export,
-            force_export=force_export,
-            keep_build_dirs=keep_build_dirs,
-            delete_build_dirs=delete_build_dirs,
-        )
+    run_session(
+        lambda session: session.submit("eu.tiliado.NuvolaCdk", branch),
+        export=get_export_mode(no_export, force_export),
+        keep_build_dirs=keep_build_dirs,
+        delete_build_dirs=delete_build_dirs,
     )
 
 
@@ -65,14 +106,11 @@ def buildadk(
     keep_build_dirs: bool = False,
     delete_build_dirs: bool = False,
 ):
-    asyncio.run(
-        build_adk(
-            branch,
-            no_export=no_export,
-            force_export=force_export,
-            keep_build_dirs=keep_build_dirs,
-            delete_build_dirs=delete_build_dirs,
-        )
+    run_session(
+        lambda session: session.submit("eu.tiliado.NuvolaAdk", branch),
+        export=get_export_mode(no_export, force_export),
+        keep_build_dirs=keep_build_dirs,
+        delete_build_dirs=delete_build_dirs,
     )
 
 
@@ -84,14 +122,11 @@ def buildbase(
     keep_build_dirs: bool = False,
     delete_build_dirs: bool = False,
 ):
-    asyncio.run(
-        build_base(
-            branch,
-            no_export=no_export,
-            force_export=force_export,
-            keep_build_dirs=keep_build_dirs,
-            delete_build_dirs=delete_build_dirs,
-        )
+    run_session(
+        lambda session: session.submit("eu.tiliado.NuvolaBase", branch),
+        export=get_export_mode(no_export, force_export),
+        keep_build_dirs=keep_build_dirs,
+        delete_build_dirs=delete_build_dirs,
     )
 
 
@@ -103,14 +138,11 @@ def buildnuvola(
     keep_build_dirs: bool = False,
     delete_build_dirs: bool = False,
 ):
-    asyncio.run(
-        build_nuvola(
-            branch,
-            no_export=no_export,
-            force_export=force_export,
-            keep_build_dirs=keep_build_dirs,
-            delete_build_dirs=delete_build_dirs,
-        )
+    run_session(
+        lambda session: session.submit("eu.tiliado.Nuvola", branch),
+        export=get_export_mode(no_export, force_export),
+        keep_build_dirs=keep_build_dirs,
+        delete_build_dirs=delete_build_dirs,
     )
 
 
@@ -122,19 +154,25 @@ def buildapps(
     keep_build_dirs: bool = False,
     delete_build_dirs: bool = False,
     concurrency: int = None,
+    pin_commits: bool = False,
+    batch_install: bool = False,
+    batch_sign: bool = False,
 ):
-    asyncio.run(
-        build_apps(
-            branch,
-            no_export=no_export,
-            force_export=force_export,
-            keep_build_dirs=keep_build_dirs,
-            delete_build_dirs=delete_build_dirs,
-            concurrency=concurrency,
-        )
+    run_session(
+        lambda session: build_apps(session, branch, pin_commits=pin_commits, batch_install=batch_install),
+        concurrency=concurrency,
+        batch_sign=batch_sign,
+        export=get_export_mode(no_export, force_export),
+        keep_build_dirs=keep_build_dirs,
+        delete_build_dirs=delete_build_dirs,
     )
 
 
+def mirrorapps(branches: str, *, jobs: int = 8):
+    """Update git mirrors of app sources and record their commits for buildapps and buildall --pin-commits."""
+    run_session(lambda session: update_app_mirrors(session, branches, jobs=jobs))
+
+
 def buildapp(
     branch: str,
     name: str,
@@ -144,15 +182,11 @@ def buildapp(
     keep_build_dirs: bool = False,
     delete_build_dirs: bool = False,
 ):
-    return asyncio.run(
-        build_app(
-            branch,
-            name,
-            no_export=no_export,
-            force_export=force_export,
-            keep_build_dirs=keep_build_dirs,
-            delete_build_dirs=delete_build_dirs,
-        )
+    run_session(
+        lambda session: session.submit(APP_MANIFEST, branch, get_app_subst(name)),
+        export=get_export_mode(no_export, force_export),
+        keep_build_dirs=keep_build_dirs,
+        delete_build_dirs=delete_build_dirs,
     )
 
 
@@ -164,27 +198,61 @@ def buildall(
     keep_build_dirs: bool = False,
     delete_build_dirs: bool = False,
     concurrency: int = None,
+    prefetch_jobs: int = 8,
+    pin_commits: bool = False,
+    batch_install: bool = False,
+    batch_sign: bool = False,
+    trace: str = None,
 ):
-    asyncio.run(
-        build_all(
-            branch,
-            no_export=no_export,
-            force_export=force_export,
+    if trace:
+        enable_tracing()
+    try:
+        run_session(
+            lambda session: build_all(
+                session, branch, prefetch_jobs=prefetch_jobs, pin_commits=pin_commits, batch_install=batch_install
+            ),
+            concurrency=concurrency,
+            batch_sign=batch_sign,
+            export=get_export_mode(no_export, force_export),
             keep_build_dirs=keep_build_dirs,
             delete_build_dirs=delete_build_dirs,
-            concurrency=concurrency,
+        )
+    finally:
+        if trace:
+            asyncio.run(save_trace(Path(trace)))
+
+
+def plan(branches: str, *, force_export: bool = False, pin_commits: bool = False):
+    """Print builds of buildall with durations predicted from the build history and the critical path."""
+    print(
+        format_plan(
+            run_session(lambda session: plan_all(session, branches, force_export=force_export, pin_commits=pin_commits))
         )
     )
 
 
-def updaterepo():
-    config = asyncio.run(utils.load_yaml(Path.cwd() / "nufb.yml"))
-    asyncio.run(update_repo(config))
+def updaterepo(*, force: bool = False):
+    config = asyncio.run(load_config())
+    asyncio.run(update_repo(config, force))
+
+
+def publish(destination: str, *, jobs: int = 8):
+    """Copy new objects, deltas and refs of the repository to a mirror directory, the summary last."""
+    config = asyncio.run(load_config())
+    repo_dir = Path(os.path.expandvars(os.path.expanduser(config["repository"]["path"]))).absolute()
+    asyncio.run(publish_repo(repo_dir, Path(destination), jobs))
 
 
 def prunerepo(depth: int):
-    config = asyncio.run(utils.load_yaml(Path.cwd() / "nufb.yml"))
+    config = asyncio.run(load_config())
     asyncio.run(prune_repo(config, depth))
 
+
+def sizes(manifest_id: str, branch: str, *, top: int = 20, rules: bool = False):
+    """Print modules or x-keep rules contributing most to the installed size of a flatpak."""
+    report = asyncio.run(load_size_report(manifest_id, branch))
+    print(format_size_report(report, top, rules))
+
+
 if __name__ == "__main__":
     sys.exit(main())
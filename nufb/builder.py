@@ -5,27 +5,54 @@
 import asyncio
 import json
 import os
+import time
 from asyncio import BoundedSemaphore, Lock
-from contextlib import suppress
+from contextlib import asynccontextmanager, suppress
+from functools import partial
 from os.path import expanduser, expandvars
 from pathlib import Path
-from typing import Any, Dict, Optional
+from statistics import median
+from typing import Any, AsyncIterator, Dict, List, Optional
 
-from nufb import fs, utils
+from nufb import fs, history, metrics, utils
+from nufb.buildlog import ModuleProfiler
+from nufb.fingerprint import compute_fingerprint
+from nufb.git import get_git_ref, get_git_url, resolve_mirror_commit, update_mirror
 from nufb.logging import get_logger
 from nufb.manifest import Manifest
-from nufb.repo import update_repo
-from nufb.utils import exec_subprocess
+from nufb.prefetch import prefetch_sources
+from nufb.repo import (
+    are_trees_unchanged,
+    get_exported_commit,
+    get_repo_refs,
+    sign_refs,
+    update_repo,
+    update_summary,
+)
+from nufb.scheduler import BuildGraph, BuildNode
+from nufb.slots import BuildSlots
+from nufb.template import load_document
+from nufb.tracing import span, wait_for
+from nufb.utils import stream_subprocess
 
 LOGGER = get_logger(__name__)
 
 
 class Locks:
-    def __init__(self):
+    def __init__(self, config: dict = None, defer_signing: bool = False):
+        """
+        :param config: Configuration.
+        :param defer_signing: Builds which defer their installation also defer signing of their commits.
+        """
         self.download = Lock()
-        self.build = Lock()
+        self.build = BuildSlots.from_config(config)
         self.export = Lock()
         self.install = Lock()
+        #: Refs exported by builds which defer their installation to the end of the run.
+        self.deferred_installs: List[str] = []
+        self.defer_signing = defer_signing
+        #: Refs merged without signing their commits.
+        self.unsigned_refs: List[str] = []
 
 
 class Builder:
@@ -42,6 +69,10 @@ class Builder:
     global_state_dir: Path
     working_state_dir: Path
     manifest_json: Path
+    staging_dir: Path
+    phases: Dict[str, float]
+    result_size: Optional[int]
+    profiler: ModuleProfiler
 
     def __init__(self, build_root: Path, resources_dir: Path, manifest: Manifest, config: dict, locks: Locks):
         self.locks = locks
@@ -57,13 +88,21 @@ class Builder:
         self.global_state_dir = build_root / "flatpak-builder"
         self.working_state_dir = self.build_dir / ".flatpak-builder"
         self.manifest_json = self.build_dir / (self.name + ".json")
+        self.fingerprint_file = build_root / "fingerprints" / self.name
+        self.log_file = build_root / "logs" / (self.name + ".log")
+        self.staging_dir = build_root / "staging" / self.name
+        self.history_file = build_root / history.HISTORY_FILE
+        self.phases = {}
+        self.result_size = None
+        self.profiler = ModuleProfiler()
 
     async def build(
         self,
         keep_build_dirs: bool = False,
         delete_build_dirs: bool = False,
         export: bool = None,
-    ):
+        defer_install: bool = False,
+    ) -> str:
         """
         Build the flatpak.
 
@@ -71,32 +110,110 @@ class Builder:
             build is successful.
         :param bool delete_build_dirs: Delete the build dirs even if the build
             fails.
+        :param export: Export the build even if nothing changed (`True`), don't
+            export at all (`False`), or export only changes (`None`) and skip
+            the build if its inputs haven't changed since the last export.
+        :param defer_install: Don't install the exported build, add it to
+            :attr:`Locks.deferred_installs` to be installed by :func:`install_deferred`.
+        :return: The outcome of the build, see :mod:`nufb.history`.
         :raise OSError: When a filesystem operation fails.
         """
+        self.prepare()
+        self.phases = {}
+        self.result_size = None
+        self.profiler = ModuleProfiler()
+        started = time.time()
+        outcome = history.OUTCOME_FAILED
+        metrics.inc("nufb_builds", state="running")
+        try:
+            outcome = await self._build(keep_build_dirs, delete_build_dirs, export, defer_install)
+        finally:
+            metrics.dec("nufb_builds", state="running")
+            metrics.inc("nufb_builds_done_total", outcome=outcome)
+            commit = None
+            if outcome == history.OUTCOME_EXPORTED:
+                metrics.inc("nufb_exported_bytes_total", self.result_size or 0)
+                commit = await get_exported_commit(self.repo_dir, self.manifest.id, self.manifest.branch)
+            await history.record_build(
+                self.history_file,
+                self.manifest.id,
+                self.manifest.branch,
+                started,
+                time.time() - started,
+                outcome,
+                self.phases,
+                commit,
+                self.result_size,
+                self.profiler.modules,
+            )
+        return outcome
+
+    async def _build(
+        self, keep_build_dirs: bool, delete_build_dirs: bool, export: Optional[bool], defer_install: bool
+    ) -> str:
+        fingerprint = None
+        if export is not False:
+            fingerprint = await compute_fingerprint(self.manifest, self.resources_dir)
+            if export is None and fingerprint is not None and fingerprint == await self.load_fingerprint():
+                LOGGER.info("Build of %s skipped: Inputs haven't changed since the last export.", self.name)
+                return history.OUTCOME_SKIPPED
+
         # Build dir is kept on failure by default.
         clean_up = delete_build_dirs
         try:
-            await self.set_up()
-            await self.copy_resources()
+            async with self.phase("set_up"):
+                await self.set_up()
+            async with self.phase("copy_resources"):
+                await self.copy_resources()
             await self.build_flatpak(
                 keep_build_dirs=keep_build_dirs,
                 delete_build_dirs=delete_build_dirs,
                 require_changes=export is not True,
             )
 
+            if await fs.isdir(self.result_dir):
+                self.result_size = await utils.get_tree_size(self.result_dir / "files")
+
             if export is not False:
-                await self.export_flatpak()
+                if await self.export_flatpak(defer_install):
+                    outcome = history.OUTCOME_EXPORTED
+                else:
+                    outcome = history.OUTCOME_UNCHANGED
+                if fingerprint is not None:
+                    await self.save_fingerprint(fingerprint)
             else:
                 LOGGER.info("Export skipped as requested.")
+                outcome = history.OUTCOME_BUILT
 
             # Build dir is deleted on success by default.
             clean_up = not keep_build_dirs
-        except Exception:
-            clean_up = False
-            raise
         finally:
             if clean_up:
-                await self.clean_up()
+                async with self.phase("clean_up"):
+                    await self.clean_up()
+        return outcome
+
+    def prepare(self) -> None:
+        """
+        Apply the changes every build makes to the manifest before its fingerprint is computed.
+
+        It must be called only once per manifest.
+        """
+        self.manifest.process_stage_keep_rules()
+
+    @asynccontextmanager
+    async def phase(self, name: str) -> AsyncIterator[None]:
+        """
+        Measure the duration of a build phase and record its span.
+
+        :param name: The name of the phase.
+        """
+        start = time.monotonic()
+        try:
+            async with span(name, self.name, manifest=self.manifest.id, branch=self.manifest.branch):
+                yield
+        finally:
+            self.phases[name] = self.phases.get(name, 0.0) + time.monotonic() - start
 
     async def set_up(self):
         """
@@ -106,8 +223,32 @@ class Builder:
         """
         with suppress(FileNotFoundError):
             await fs.rmtree(self.build_dir)
+        with suppress(FileNotFoundError):
+            await fs.remove(self.log_file)
         await fs.makedirs(self.build_dir, exist_ok=True)
-        self.manifest.process_stage_keep_rules()
+
+    async def load_fingerprint(self) -> Optional[str]:
+        """
+        Load the fingerprint of inputs of the last exported build.
+
+        :return: The fingerprint or `None` if there is none.
+        :raise OSError: When a filesystem operation fails.
+        """
+        try:
+            async with fs.open(self.fingerprint_file) as fh:
+                return (await fh.read()).strip()
+        except FileNotFoundError:
+            return None
+
+    async def save_fingerprint(self, fingerprint: str) -> None:
+        """
+        Save the fingerprint of inputs of an exported build.
+
+        :raise OSError: When a filesystem operation fails.
+        """
+        await fs.makedirs(self.fingerprint_file.parent, exist_ok=True)
+        async with fs.open(self.fingerprint_file, "w") as fh:
+            await fh.write(fingerprint + "\n")
 
     async def copy_resources(self):
         """
@@ -125,18 +266,8 @@ class Builder:
 
         tasks = []
 
-        for module in self.manifest.modules:
-            for source in self.manifest.sources(module, create=False):
-                if isinstance(source, str):
-                    path = source
-                elif source["type"] in ("file", "patch", "archive"):
-                    path = source.get("path", "")
-                else:
-                    continue
-
-                if not path or os.path.isabs(path):
-                    continue
-
+        for path in self.manifest.local_files():
+            if not os.path.isabs(path):
                 tasks.append(task(self.resources_dir / path, self.build_dir / path))
 
         await asyncio.gather(*tasks)
@@ -189,45 +320,64 @@ class Builder:
 
         argv = ["flatpak-builder", "--download-only"] + args
 
-        async with self.locks.download:
+        async with self.phase("download"), wait_for(self.locks.download, "download", self.name):
             LOGGER.debug("Running %s in %s.", argv, work_dir)
-            code, out = await exec_subprocess(argv, cwd=work_dir)
+            code, out = await stream_subprocess(argv, self.log_file, prefix=self.name, cwd=work_dir)
             if code:
                 LOGGER.error("%s returned %d.\n%s", argv, code, out)
                 raise ValueError(code)
             else:
-                LOGGER.info("%s returned %d.\n%s", argv, code, out)
+                LOGGER.info("%s returned %d.", argv, code)
+
+        build_slot = self.locks.build.acquire(self.manifest.id)
+        async with self.phase("build"), wait_for(build_slot, "build", self.name) as jobs:
+            argv = ["flatpak-builder", "--ccache", "--disable-download", f"--jobs={jobs}"]
+            if disable_cache:
+                argv.append("--disable-cache")
+            if require_changes:
+                argv.append("--require-changes")
+            if keep_build_dirs:
+                argv.append("--keep-build-dirs")
+            if delete_build_dirs:
+                argv.append("--delete-build-dirs")
+
+            argv.extend(args)
 
-        argv = ["flatpak-builder", "--ccache", "--disable-download"]
-        if disable_cache:
-            argv.append("--disable-cache")
-        if require_changes:
-            argv.append("--require-changes")
-        if keep_build_dirs:
-            argv.append("--keep-build-dirs")
-        if delete_build_dirs:
-            argv.append("--delete-build-dirs")
-
-        argv.extend(args)
-
-        async with self.locks.build:
             LOGGER.debug("Running %s in %s.", argv, work_dir)
-            code, out = await exec_subprocess(argv, cwd=work_dir)
+            code, out = await stream_subprocess(
+                argv, self.log_file, prefix=self.name, on_line=self.profiler.feed, cwd=work_dir
+            )
+            self.profiler.finish()
+            if self.profiler.modules:
+                LOGGER.info("Modules of %s: %s", self.name, self.profiler.format_summary())
             if code:
                 LOGGER.error("%s returned %d.\n%s", argv, code, out)
                 raise ValueError(code)
             else:
-                LOGGER.info("%s returned %d.\n%s", argv, code, out)
+                LOGGER.info("%s returned %d.", argv, code)
 
-    async def export_flatpak(self):
+    async def export_flatpak(self, defer_install: bool = False) -> bool:
+        """
+        Export the build to the repository and install it.
+
+        The build is exported to its own staging repository first, so that exports of concurrent builds don't wait
+        for each other. The commits are then merged into the repository by :meth:`merge_staging_repo`.
+
+        :param defer_install: Add the exported refs to :attr:`Locks.deferred_installs` instead of installing them.
+        :return: `False` if there was nothing new to export or the file trees are identical to the exported ones,
+            `True` otherwise.
+        """
         await fs.makedirs(self.repo_dir, exist_ok=True)
         work_dir = self.build_dir
         result_dir = work_dir / "result"
         if not await fs.isdir(result_dir):
             LOGGER.info("Nothing new to export to the repository.")
-            return
+            return False
 
-        base_argv = ["flatpak", "build-export", "-v", f"--gpg-sign={self.key_id}"]
+        with suppress(FileNotFoundError):
+            await fs.rmtree(self.staging_dir)
+        await fs.makedirs(self.staging_dir.parent, exist_ok=True)
+        base_argv = ["flatpak", "build-export", "-v", "--no-update-summary"]
 
         argv = base_argv + [
             "-s",
@@ -236,19 +386,19 @@ class Builder:
             "--metadata=metadata",
             "--exclude=/lib/debug/*",
             "--include=/lib/debug/app",
-            str(self.repo_dir),
+            str(self.staging_dir),
             str(result_dir),
             self.manifest.branch,
         ]
 
-        async with self.locks.export:
+        async with self.phase("export app"):
             LOGGER.debug("Exporting %s app %s %s", self.manifest.id, self.manifest.branch, argv)
-            code, out = await exec_subprocess(argv, cwd=work_dir)
+            code, out = await stream_subprocess(argv, self.log_file, prefix=self.name, cwd=work_dir)
             if code:
                 LOGGER.error("%s returned %d.\n%s", argv, code, out)
                 raise ValueError(code)
             else:
-                LOGGER.info("%s returned %d.\n%s", argv, code, out)
+                LOGGER.info("%s returned %d.", argv, code)
 
         argv = base_argv + [
             "-s",
@@ -256,40 +406,92 @@ class Builder:
             "--runtime",
             "--files=files/lib/debug",
             "--metadata=metadata.debuginfo",
-            str(self.repo_dir),
+            str(self.staging_dir),
             str(result_dir),
             self.manifest.branch,
         ]
 
-        async with self.locks.export:
+        async with self.phase("export debuginfo"):
             LOGGER.debug("Exporting %s debuginfo %s %s", self.manifest.id, self.manifest.branch, argv)
-            code, out = await exec_subprocess(argv, cwd=work_dir)
+            code, out = await stream_subprocess(argv, self.log_file, prefix=self.name, cwd=work_dir)
             if code:
                 LOGGER.error("%s returned %d.\n%s", argv, code, out)
                 raise ValueError(code)
             else:
-                LOGGER.info("%s returned %d.\n%s", argv, code, out)
+                LOGGER.info("%s returned %d.", argv, code)
+
+        refs = await get_repo_refs(self.staging_dir)
+        if await are_trees_unchanged(self.staging_dir, self.repo_dir, refs):
+            LOGGER.info("Export of %s skipped: The result is identical to the exported one.", self.name)
+            await fs.rmtree(self.staging_dir)
+            return False
+
+        sign = not (defer_install and self.locks.defer_signing)
+        await self.merge_staging_repo(update_summary=not defer_install, sign=sign)
+
+        if defer_install:
+            LOGGER.info("Installation of %s deferred.", self.name)
+            self.locks.deferred_installs.append(f"{self.manifest.id}//{self.manifest.branch}")
+            self.locks.deferred_installs.append(f"{self.manifest.id}.Debug//{self.manifest.branch}")
+            return True
 
         argv = ["flatpak", "install", "--or-update", "--assumeyes", f"{self.manifest.id}//{self.manifest.branch}"]
 
-        async with self.locks.install:
+        async with self.phase("install app"), wait_for(self.locks.install, "install", self.name):
             LOGGER.debug("Installing or updating %s//%s %s", self.manifest.id, self.manifest.branch, argv)
-            code, out = await exec_subprocess(argv, cwd=work_dir)
+            code, out = await stream_subprocess(argv, self.log_file, prefix=self.name, cwd=work_dir)
             if code:
                 LOGGER.error("%s returned %d.\n%s", argv, code, out)
                 raise ValueError(code)
             else:
-                LOGGER.info("%s returned %d.\n%s", argv, code, out)
+                LOGGER.info("%s returned %d.", argv, code)
 
         argv = ["flatpak", "install", "--or-update", "--assumeyes", f"{self.manifest.id}.Debug//{self.manifest.branch}"]
-        async with self.locks.install:
+        async with self.phase("install debuginfo"), wait_for(self.locks.install, "install", self.name):
             LOGGER.debug("Installing or updating %s.Debug//%s %s", self.manifest.id, self.manifest.branch, argv)
-            code, out = await exec_subprocess(argv, cwd=work_dir)
+            code, out = await stream_subprocess(argv, self.log_file, prefix=self.name, cwd=work_dir)
+            if code:
+                LOGGER.error("%s returned %d.\n%s", argv, code, out)
+                raise ValueError(code)
+            else:
+                LOGGER.info("%s returned %d.", argv, code)
+
+        return True
+
+    async def merge_staging_repo(self, update_summary: bool = True, sign: bool = True) -> None:
+        """
+        Merge commits from the staging repository into the repository.
+
+        All refs of the build are committed in a single transaction, which updates them atomically. The new
+        commits have the current commits of the refs as parents, so the history of the repository is preserved.
+
+        :param update_summary: Update the summary of the repository, so that the refs can be installed.
+        :param sign: Sign the commits, otherwise add the refs to :attr:`Locks.unsigned_refs` to be signed later by
+            :func:`install_deferred`.
+        :raise ValueError: On failure.
+        :raise OSError: When a filesystem operation fails.
+        """
+        refs = await get_repo_refs(self.staging_dir)
+        argv = ["flatpak", "build-commit-from", "-v", f"--src-repo={self.staging_dir}"]
+        if sign:
+            argv.append(f"--gpg-sign={self.key_id}")
+        if not update_summary:
+            argv.append("--no-update-summary")
+        argv.append(str(self.repo_dir))
+        argv.extend(refs)
+
+        async with self.phase("merge"), wait_for(self.locks.export, "export", self.name):
+            LOGGER.debug("Merging %s %s %s", self.manifest.id, self.manifest.branch, argv)
+            code, out = await stream_subprocess(argv, self.log_file, prefix=self.name, cwd=self.build_dir)
             if code:
                 LOGGER.error("%s returned %d.\n%s", argv, code, out)
                 raise ValueError(code)
             else:
-                LOGGER.info("%s returned %d.\n%s", argv, code, out)
+                LOGGER.info("%s returned %d.", argv, code)
+            if not sign:
+                self.locks.unsigned_refs.extend(refs)
+
+        await fs.rmtree(self.staging_dir)
 
     async def clean_up(self):
         """
@@ -299,271 +501,492 @@ class Builder:
         """
         with suppress(FileNotFoundError):
             await fs.rmtree(self.build_dir)
+        with suppress(FileNotFoundError):
+            await fs.rmtree(self.staging_dir)
 
 
-async def build(
-    locks: Locks,
-    config: dict,
-    build_root: Path,
-    resources_dir: Path,
-    manifests_dir: Path,
-    manifest_id: str,
-    branch: str,
-    *,
-    subst: Dict[str, Any] = None,
-    **kwargs,
-) -> None:
+def get_export_mode(no_export: bool = False, force_export: bool = False) -> Optional[bool]:
     """
-    Star a build.
+    Get the `export` parameter of :meth:`Builder.build` from command-line flags.
 
-    :param locks: Builder locks.
-    :param subst: Manifest substitutions.
-    :param config: Configuration.
-    :param build_root: The root build directory.
-    :param resources_dir: The directory containing build resources.
-    :param manifests_dir: The directory where manifests are stored.
-    :param manifest_id: The id of the manifest.
-    :param branch: The branch of the manifest.
-    :param kwargs: Other parameters for the builder.
+    :param no_export: Don't export the build at all.
+    :param force_export: Export the build even if nothing changed.
+    :return: `False`, `True`, or `None` to export only changes.
+    """
+    if no_export:
+        return False
+    if force_export:
+        return True
+    return None
+
+
+#: Manifests of flatpaks shared by all apps.
+SHARED_MANIFESTS = ("eu.tiliado.NuvolaCdk", "eu.tiliado.NuvolaAdk", "eu.tiliado.NuvolaBase", "eu.tiliado.Nuvola")
+#: The manifest template of apps, see :func:`get_app_subst`.
+APP_MANIFEST = "eu.tiliado.NuvolaApp"
+
+
+class BuildSession:
     """
+    Builds sharing configuration, locks, caches and the concurrency policy.
 
-    LOGGER.debug("build(%s, %s, %s, %s, %s)", build_root, resources_dir, manifests_dir, manifest_id, branch)
+    A session is created once and any number of builds are submitted to it::
 
-    data = await utils.load_yaml(manifests_dir / branch / (manifest_id + ".yml"), subst=subst)
-    manifest = Manifest(data, branch, subst)
-    builder = Builder(build_root, resources_dir, manifest, config, locks)
-    await builder.build(**kwargs)
+        session = await BuildSession.create(concurrency=4, export=True)
+        outcomes = await asyncio.gather(
+            *(session.submit(APP_MANIFEST, "master", get_app_subst(name)) for name in names)
+        )
+        await session.install_deferred()
+    """
 
+    config: dict
+    build_root: Path
+    resources_dir: Path
+    manifests_dir: Path
+    locks: Locks
+    concurrency: Optional[int]
+    options: Dict[str, Any]
 
-async def build_cdk(
-    branch: str,
-    *,
-    locks: Locks = None,
-    no_export: bool = False,
-    force_export: bool = False,
-    keep_build_dirs: bool = False,
-    delete_build_dirs: bool = False,
-):
+    def __init__(
+        self,
+        config: dict,
+        *,
+        build_root: Path = None,
+        resources_dir: Path = None,
+        manifests_dir: Path = None,
+        concurrency: int = None,
+        batch_sign: bool = False,
+        **options: Any,
+    ):
+        """
+        :param config: Configuration.
+        :param build_root: The root build directory, the user's cache directory by default.
+        :param resources_dir: The directory containing build resources, `resources` in the current directory by default.
+        :param manifests_dir: The directory where manifests are stored, `manifests` in the current directory by default.
+        :param concurrency: The maximal number of builds running at the same time, unlimited by default.
+        :param batch_sign: Builds which defer their installation also defer signing of their commits.
+        :param options: Default parameters of :meth:`Builder.build`.
+        """
+        self.config = config
+        self.build_root = build_root or utils.get_user_cache_dir("nuvola-flatpaks")
+        self.resources_dir = resources_dir or Path.cwd() / "resources"
+        self.manifests_dir = manifests_dir or Path.cwd() / "manifests"
+        self.locks = Locks(config, defer_signing=batch_sign)
+        self.concurrency = concurrency
+        self.options = options
+        self._semaphore = BoundedSemaphore(concurrency) if concurrency else None
+
+    @classmethod
+    async def create(cls, **kwargs: Any) -> "BuildSession":
+        """
+        Create a session with the configuration from `nufb.yml` in the current directory.
+
+        :param kwargs: Parameters of :class:`BuildSession`.
+        :return: New session.
+        """
+        return cls(await load_config(), **kwargs)
+
+    async def load_manifest(
+        self, manifest_id: str, branch: str, subst: Dict[str, Any] = None, git_commits: Dict[str, str] = None
+    ) -> Manifest:
+        """
+        Load a manifest.
+
+        :param manifest_id: The id of the manifest.
+        :param branch: The branch of the manifest.
+        :param subst: Manifest substitutions.
+        :param git_commits: Commits to pin git sources to, keyed by repository URL.
+        :return: The manifest.
+        """
+        data = await load_document(self.manifests_dir / branch / (manifest_id + ".yml"), subst)
+        manifest = Manifest(data, branch, subst)
+
+        if git_commits:
+            for source in manifest.git_sources():
+                commit = git_commits.get(get_git_url(source) or "")
+                if commit and "commit" not in source:
+                    manifest.pin_git_source(source, commit)
+        return manifest
+
+    def submit(self, manifest_id: str, branch: str, subst: Dict[str, Any] = None, **kwargs: Any) -> asyncio.Future:
+        """
+        Start a build which waits for a free slot if the concurrency is limited.
+
+        :param manifest_id: The id of the manifest.
+        :param branch: The branch of the manifest.
+        :param subst: Manifest substitutions.
+        :param kwargs: Other parameters of :meth:`build_now`.
+        :return: The future outcome of the build, see :mod:`nufb.history`.
+        """
+        return asyncio.ensure_future(self._build_queued(manifest_id, branch, subst, **kwargs))
+
+    async def _build_queued(self, manifest_id: str, branch: str, subst: Optional[Dict[str, Any]], **kwargs) -> str:
+        if self._semaphore is None:
+            return await self.build_now(manifest_id, branch, subst, **kwargs)
+
+        metrics.inc("nufb_builds", state="queued")
+        async with self._semaphore:
+            metrics.dec("nufb_builds", state="queued")
+            metrics.inc("nufb_session_holders")
+            try:
+                return await self.build_now(manifest_id, branch, subst, **kwargs)
+            finally:
+                metrics.dec("nufb_session_holders")
+
+    async def build_now(
+        self,
+        manifest_id: str,
+        branch: str,
+        subst: Dict[str, Any] = None,
+        *,
+        git_commits: Dict[str, str] = None,
+        **options: Any,
+    ) -> str:
+        """
+        Build a flatpak right away, regardless of the concurrency limit.
+
+        This is meant for schedulers which enforce the limit themselves, such as :meth:`BuildGraph.run`.
+
+        :param manifest_id: The id of the manifest.
+        :param branch: The branch of the manifest.
+        :param subst: Manifest substitutions.
+        :param git_commits: Commits to pin git sources to, keyed by repository URL.
+        :param options: Parameters of :meth:`Builder.build` overriding :attr:`options`.
+        :return: The outcome of the build, see :mod:`nufb.history`.
+        """
+        LOGGER.debug("build(%s, %s, %s, %s)", self.build_root, self.manifests_dir, manifest_id, branch)
+        manifest = await self.load_manifest(manifest_id, branch, subst, git_commits)
+        builder = Builder(self.build_root, self.resources_dir, manifest, self.config, self.locks)
+        return await builder.build(**{**self.options, **options})
+
+    async def install_deferred(self, failed: bool = False) -> None:
+        """
+        Install builds which deferred their installation, see :func:`install_deferred`.
+
+        :param failed: Some builds have failed. A failure of the installation is then only logged, so that it
+            doesn't replace the error of the builds.
+        :raise ValueError: On failure.
+        :raise OSError: When a filesystem operation fails.
+        """
+        try:
+            await install_deferred(self.config, self.locks)
+        except (OSError, ValueError):
+            if not failed:
+                raise
+            LOGGER.exception("Failed to install deferred builds.")
+
+
+async def build_apps(session: BuildSession, branch: str, *, pin_commits: bool = False, batch_install: bool = False):
     """
-    Build Nuvola CDK
+    Build all apps of a branch.
 
+    :param session: The build session.
     :param branch: The branch to build.
-    :param bool keep_build_dirs: Keep the build directories even if the
-        build is successful.
-    :param bool delete_build_dirs: Delete the build dirs even if the build
-        fails.
+    :param pin_commits: Build app sources from commits recorded by :func:`update_app_mirrors`.
+    :param batch_install: Install all exported apps in one transaction after all builds finish. Implied by
+        `batch_sign` of the session.
     """
-    export: Optional[bool]
-    if no_export:
-        export = False
-    elif force_export:
-        export = True
-    else:
-        export = None
-    await build(
-        locks or Locks(),
-        await utils.load_yaml(Path.cwd() / "nufb.yml"),
-        utils.get_user_cache_dir("nuvola-flatpaks"),
-        Path.cwd() / "resources",
-        Path.cwd() / "manifests",
-        "eu.tiliado.NuvolaCdk",
-        branch,
-        keep_build_dirs=keep_build_dirs,
-        delete_build_dirs=delete_build_dirs,
-        export=export,
-    )
+    apps = get_apps(session.config, branch)
+    app_commits = (await load_app_commits(session.build_root)).get(branch, {}) if pin_commits else {}
+    batch_install = batch_install or session.locks.defer_signing
+    builds = [
+        session.submit(
+            APP_MANIFEST, branch, get_app_subst(name), git_commits=app_commits.get(name), defer_install=batch_install
+        )
+        for name in apps
+    ]
 
+    if not batch_install:
+        await asyncio.gather(*builds)
+        return
 
-async def build_adk(
-    branch: str,
-    *,
-    locks: Locks = None,
-    no_export: bool = False,
-    force_export: bool = False,
-    keep_build_dirs: bool = False,
-    delete_build_dirs: bool = False,
-):
-    export: Optional[bool]
-    if no_export:
-        export = False
-    elif force_export:
-        export = True
-    else:
-        export = None
-    await build(
-        locks or Locks(),
-        await utils.load_yaml(Path.cwd() / "nufb.yml"),
-        utils.get_user_cache_dir("nuvola-flatpaks"),
-        Path.cwd() / "resources",
-        Path.cwd() / "manifests",
-        "eu.tiliado.NuvolaAdk",
-        branch,
-        keep_build_dirs=keep_build_dirs,
-        delete_build_dirs=delete_build_dirs,
-        export=export,
-    )
+    results = await asyncio.gather(*builds, return_exceptions=True)
+    errors = [result for result in results if isinstance(result, BaseException)]
+    await session.install_deferred(failed=bool(errors))
+    if errors:
+        raise errors[0]
 
 
-async def build_base(
-    branch: str,
+async def build_all(
+    session: BuildSession,
+    branches: str,
     *,
-    locks: Locks = None,
-    no_export: bool = False,
-    force_export: bool = False,
-    keep_build_dirs: bool = False,
-    delete_build_dirs: bool = False,
+    prefetch_jobs: int = 8,
+    pin_commits: bool = False,
+    batch_install: bool = False,
 ):
-    export: Optional[bool]
-    if no_export:
-        export = False
-    elif force_export:
-        export = True
-    else:
-        export = None
-    await build(
-        locks or Locks(),
-        await utils.load_yaml(Path.cwd() / "nufb.yml"),
-        utils.get_user_cache_dir("nuvola-flatpaks"),
-        Path.cwd() / "resources",
-        Path.cwd() / "manifests",
-        "eu.tiliado.NuvolaBase",
-        branch,
-        keep_build_dirs=keep_build_dirs,
-        delete_build_dirs=delete_build_dirs,
-        export=export,
-    )
+    """
+    Build all flatpaks in the order given by their dependencies.
+
+    :param session: The build session. Its concurrency limits the number of builds running at the same time.
+    :param branches: Comma-separated list of branches to build.
+    :param prefetch_jobs: The number of concurrent downloads when prefetching
+        sources of all builds, zero to disable prefetching.
+    :param pin_commits: Build app sources from commits recorded by :func:`update_app_mirrors`.
+    :param batch_install: Install builds no other build depends on in one
+        transaction after all builds finish. Implied by `batch_sign` of the session.
+    """
+    app_commits = await load_app_commits(session.build_root) if pin_commits else {}
+    graph = await create_build_graph(session, branches, app_commits)
+    await weigh_builds(graph, session.build_root / history.HISTORY_FILE)
+
+    if prefetch_jobs:
+        await prefetch_sources(
+            [node.manifest for node in graph.nodes.values() if node.manifest.id in SHARED_MANIFESTS],
+            session.build_root / "flatpak-builder",
+            prefetch_jobs,
+        )
 
+    if batch_install or session.locks.defer_signing:
+        # Builds depended on by later builds (CDK and Base) must be installed right away. The others, i.e. apps,
+        # ADK and Nuvola, are deferred.
+        graph.link()
+        for node in graph.nodes.values():
+            if not node.dependents:
+                node.run = partial(node.run, defer_install=True)
 
-async def build_nuvola(
-    branch: str,
-    *,
-    locks: Locks = None,
-    no_export: bool = False,
-    force_export: bool = False,
-    keep_build_dirs: bool = False,
-    delete_build_dirs: bool = False,
-):
-    export: Optional[bool]
-    if no_export:
-        export = False
-    elif force_export:
-        export = True
+    succeeded = False
+    try:
+        await graph.run(session.concurrency)
+        succeeded = True
+    finally:
+        await session.install_deferred(failed=not succeeded)
+    await update_repo(session.config)
+
+
+async def install_deferred(config: dict, locks: Locks) -> None:
+    """
+    Install or update refs of builds which deferred their installation in one transaction.
+
+    The builds were merged into the repository without updating its summary, so it is updated first. Unsigned
+    commits are signed together right before the summary update.
+
+    :param config: Configuration.
+    :param locks: Locks with :attr:`Locks.deferred_installs`.
+    :raise ValueError: On failure.
+    """
+    refs = list(locks.deferred_installs)
+    locks.deferred_installs.clear()
+    unsigned_refs = list(locks.unsigned_refs)
+    locks.unsigned_refs.clear()
+    if not refs and not unsigned_refs:
+        return
+
+    repository = config["repository"]
+    repo_dir = Path(expandvars(expanduser(repository["path"]))).absolute()
+    async with wait_for(locks.export, "export", "installation"):
+        if unsigned_refs:
+            async with span("sign", "installation", refs=unsigned_refs):
+                await sign_refs(repo_dir, repository["key_id"], unsigned_refs)
+        await update_summary(repo_dir, repository["key_id"])
+
+    if not refs:
+        return
+
+    argv = ["flatpak", "install", "--or-update", "--assumeyes", *refs]
+    async with span("install deferred", "installation", refs=refs), wait_for(locks.install, "install", "installation"):
+        LOGGER.debug("Installing or updating %d refs %s", len(refs), argv)
+        code, out = await utils.exec_subprocess(argv)
+    if code:
+        LOGGER.error("%s returned %d.\n%s", argv, code, out)
+        raise ValueError(code)
     else:
-        export = None
-    await build(
-        locks or Locks(),
-        await utils.load_yaml(Path.cwd() / "nufb.yml"),
-        utils.get_user_cache_dir("nuvola-flatpaks"),
-        Path.cwd() / "resources",
-        Path.cwd() / "manifests",
-        "eu.tiliado.Nuvola",
-        branch,
-        keep_build_dirs=keep_build_dirs,
-        delete_build_dirs=delete_build_dirs,
-        export=export,
-    )
+        LOGGER.info("%s returned %d.", argv, code)
 
 
-async def build_apps(
-    branch: str,
-    *,
-    locks: Locks = None,
-    no_export: bool = False,
-    force_export: bool = False,
-    keep_build_dirs: bool = False,
-    delete_build_dirs: bool = False,
-    concurrency: int = None,
-):
-    config = await utils.load_yaml(Path.cwd() / "nufb.yml")
-    apps = config["apps"].get(branch)
-    if apps is None:
-        apps = config["apps"].get("master")
-    assert apps
+async def create_build_graph(
+    session: BuildSession, branches: str, app_commits: Dict[str, Dict[str, Dict[str, str]]] = None
+) -> BuildGraph:
+    """
+    Create the graph of builds of all flatpaks.
+
+    :param session: The build session to run the builds in.
+    :param branches: Comma-separated list of branches to build.
+    :param app_commits: Commits of app sources to build as returned by :func:`update_app_mirrors`.
+    :return: The graph of builds.
+    """
+    graph = BuildGraph()
+
+    for branch in branches.split(","):
+        for manifest_id in SHARED_MANIFESTS:
+            manifest = await session.load_manifest(manifest_id, branch)
+            graph.add(BuildNode(manifest, partial(session.build_now, manifest_id, branch)))
+
+        for name in get_apps(session.config, branch):
+            subst = get_app_subst(name)
+            git_commits = (app_commits or {}).get(branch, {}).get(name)
+            graph.add(
+                BuildNode(
+                    await session.load_manifest(APP_MANIFEST, branch, subst, git_commits),
+                    partial(session.build_now, APP_MANIFEST, branch, subst, git_commits=git_commits),
+                )
+            )
+
+    return graph
+
+
+async def weigh_builds(graph: BuildGraph, history_file: Path) -> Dict[BuildNode, Optional[float]]:
+    """
+    Set weights of builds to their durations predicted from the build history.
+
+    Builds without history get the median of the predicted durations, so that they are neither preferred nor
+    postponed.
+
+    :param graph: The graph of builds.
+    :param history_file: The build history database.
+    :return: Predicted durations of builds, `None` for builds without history.
+    """
+    durations = {
+        node: await history.predict_duration(history_file, node.manifest.id, node.manifest.branch)
+        for node in graph.nodes.values()
+    }
+    known = [duration for duration in durations.values() if duration is not None]
+    default = median(known) if known else 1.0
+    for node, duration in durations.items():
+        node.weight = default if duration is None else duration
+    return durations
+
+
+async def plan_all(
+    session: BuildSession, branches: str, *, force_export: bool = False, pin_commits: bool = False
+) -> List[history.PlannedBuild]:
+    """
+    Plan the builds of :func:`build_all` with their durations predicted from the build history.
 
-    if locks is None:
-        locks = Locks()
+    :param session: The build session.
+    :param branches: Comma-separated list of branches to build.
+    :param force_export: Don't skip builds whose inputs haven't changed since the last export.
+    :param pin_commits: Plan app sources pinned to commits recorded by :func:`update_app_mirrors`.
+    :return: The builds in the order of their critical paths.
+    """
+    app_commits = await load_app_commits(session.build_root) if pin_commits else {}
+    graph = await create_build_graph(session, branches, app_commits)
+    durations = await weigh_builds(graph, session.build_root / history.HISTORY_FILE)
+
+    up_to_date = set()
+    if not force_export:
+        for node in graph.nodes.values():
+            builder = Builder(session.build_root, session.resources_dir, node.manifest, session.config, session.locks)
+            builder.prepare()
+            fingerprint = await compute_fingerprint(node.manifest, session.resources_dir)
+            if fingerprint is not None and fingerprint == await builder.load_fingerprint():
+                up_to_date.add(node)
+                node.weight = 0.0
+
+    graph.link()
+    return [
+        history.PlannedBuild(node.name, durations[node], node in up_to_date, node.priority)
+        for node in sorted(graph.nodes.values(), key=lambda node: -node.priority)
+    ]
+
+
+async def update_app_mirrors(
+    session: BuildSession, branches: str, *, jobs: int = 8
+) -> Dict[str, Dict[str, Dict[str, str]]]:
+    """
+    Update git mirrors of sources of all apps of the branches in parallel and record resolved commits.
 
-    semaphore = BoundedSemaphore(concurrency or len(apps))
+    The commits are saved to be reused by later builds (see `pin_commits` of :func:`build_apps`). Failures are
+    logged and the affected apps are left out.
+
+    :param session: The build session.
+    :param branches: Comma-separated list of branches.
+    :param jobs: The number of git processes running at the same time.
+    :return: Mapping of branches to app names to commits keyed by repository URL.
+    """
+    git_dir = session.build_root / "flatpak-builder" / "git"
+    semaphore = BoundedSemaphore(jobs)
+    mirrors: Dict[str, asyncio.Future] = {}
+    commits: Dict[str, Dict[str, Dict[str, str]]] = {}
 
-    async def task(name):
+    async def update(url: str) -> Path:
         async with semaphore:
-            return await build_app(
-                branch,
-                name,
-                no_export=no_export,
-                force_export=force_export,
-                keep_build_dirs=keep_build_dirs,
-                delete_build_dirs=delete_build_dirs,
-                locks=locks,
-            )
+            return await update_mirror(url, git_dir)
 
-    await asyncio.gather(*map(task, apps))
+    async def resolve(url: str, ref: str) -> str:
+        if url not in mirrors:
+            mirrors[url] = asyncio.ensure_future(update(url))
+        mirror = await mirrors[url]
+        async with semaphore:
+            return await resolve_mirror_commit(mirror, ref)
 
+    async def task(branch: str, name: str) -> None:
+        manifest = await session.load_manifest(APP_MANIFEST, branch, get_app_subst(name))
+        sources = [(get_git_url(source), get_git_ref(source)) for source in manifest.git_sources()]
+        try:
+            resolved = await asyncio.gather(*(resolve(url, ref) for url, ref in sources if url))
+        except (OSError, ValueError) as e:
+            LOGGER.warning("Failed to update git mirrors of %s//%s.", name, branch, exc_info=e)
+        else:
+            commits.setdefault(branch, {})[name] = dict(zip((url for url, _ref in sources if url), resolved))
+
+    await asyncio.gather(
+        *(task(branch, name) for branch in branches.split(",") for name in get_apps(session.config, branch))
+    )
 
-async def build_app(
-    branch: str,
-    name: str,
-    *,
-    locks: Locks = None,
-    no_export: bool = False,
-    force_export: bool = False,
-    keep_build_dirs: bool = False,
-    delete_build_dirs: bool = False,
-):
-    export: Optional[bool]
-    if no_export:
-        export = False
-    elif force_export:
-        export = True
-    else:
-        export = None
+    recorded = await load_app_commits(session.build_root)
+    recorded.update(commits)
+    await fs.makedirs(session.build_root, exist_ok=True)
+    async with fs.open(session.build_root / "app-commits.json", "w") as fh:
+        await fh.write(json.dumps(recorded, indent=2, sort_keys=True) + "\n")
+    return commits
+
+
+async def load_app_commits(build_root: Path) -> Dict[str, Dict[str, Dict[str, str]]]:
+    """
+    Load commits of app sources recorded by :func:`update_app_mirrors`.
+
+    :param build_root: The root build directory.
+    :return: Mapping of branches to app names to commits keyed by repository URL.
+    """
+    try:
+        async with fs.open(build_root / "app-commits.json") as fh:
+            return json.loads(await fh.read())
+    except FileNotFoundError:
+        return {}
+
+
+async def load_config() -> dict:
+    """
+    Load the configuration from `nufb.yml` in the current directory.
+
+    The file is parsed only once while it doesn't change.
+
+    :return: Configuration.
+    """
+    return await load_document(Path.cwd() / "nufb.yml")
 
+
+def get_apps(config: dict, branch: str) -> List[str]:
+    """
+    Get the apps to build for a branch.
+
+    :param config: Configuration.
+    :param branch: The branch to build.
+    :return: App names, optionally with `@app-branch` suffix.
+    """
+    apps = config["apps"].get(branch)
+    if apps is None:
+        apps = config["apps"].get("master")
+    assert apps
+    return apps
+
+
+def get_app_subst(name: str) -> Dict[str, str]:
+    """
+    Get substitutions of the app manifest template.
+
+    :param name: The app name, optionally with `@app-branch` suffix.
+    :return: Manifest substitutions.
+    """
     if "@" in name:
         name, app_branch = name.split("@")
     else:
         app_branch = "master"
 
-    subst = {
+    return {
         "APP_ID_DASH": name,
         "APP_ID_UNDERSCORE": name.replace("-", "_"),
         "APP_ID_UNIQUE": "".join(s.capitalize() for s in name.split("-")),
         "APP_BRANCH": app_branch,
     }
-    return await build(
-        locks or Locks(),
-        await utils.load_yaml(Path.cwd() / "nufb.yml"),
-        utils.get_user_cache_dir("nuvola-flatpaks"),
-        Path.cwd() / "resources",
-        Path.cwd() / "manifests",
-        "eu.tiliado.NuvolaApp",
-        branch,
-        keep_build_dirs=keep_build_dirs,
-        delete_build_dirs=delete_build_dirs,
-        export=export,
-        subst=subst,
-    )
-
-
-async def build_all(
-    branches: str,
-    *,
-    concurrency: int = None,
-    **kwargs,
-):
-    locks = Locks()
-    config = await utils.load_yaml(Path.cwd() / "nufb.yml")
-
-    async def base_and_apps(branch):
-        await build_base(branch, locks=locks, **kwargs)
-        await asyncio.gather(
-            build_nuvola(branch, locks=locks, **kwargs),
-            build_apps(branch, locks=locks, concurrency=concurrency, **kwargs),
-        )
-
-    for branches in branches.split(","):
-        await build_cdk(branches, locks=locks, **kwargs)
-        await asyncio.gather(
-            base_and_apps(branches),
-            build_adk(branches, locks=locks, **kwargs),
-        )
-    await update_repo(config)
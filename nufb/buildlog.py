@@ -0,0 +1,95 @@
+# Copyright 2019-2020 Jiří Janoušek <janousek.jiri@gmail.com>
+# License: BSD-2-Clause, see file LICENSE at the project root.
+"""
+Profiling of modules parsed from the output of flatpak-builder.
+"""
+import re
+import time
+from typing import Callable, Dict, Optional
+
+#: flatpak-builder starts to build a module which missed the cache.
+BUILDING_RE = re.compile(r"^Building module (\S+) in ")
+#: flatpak-builder committed a built module to the cache.
+COMMITTING_RE = re.compile(r"^Committing stage build-(\S+) to cache$")
+#: flatpak-builder reused a module from the cache. Hits of other stages (`init`, `cleanup`, `finish`) don't match.
+CACHE_HIT_RE = re.compile(r"^Cache hit for build-(\S+), skipping$")
+
+CACHE_HIT = "hit"
+CACHE_MISS = "miss"
+
+
+class ModuleStats:
+    cache: str
+    duration: float
+    finished: bool
+
+    def __init__(self, cache: str, duration: float = 0.0, finished: bool = True):
+        self.cache = cache
+        self.duration = duration
+        self.finished = finished
+
+
+class ModuleProfiler:
+    """
+    Measure the durations and cache status of modules from the output of flatpak-builder as it arrives.
+
+    A module that missed the cache is measured from `Building module` to `Committing stage build-<name>`. A module
+    in progress when the output ends (e.g. on a failure) is measured to the end and marked unfinished.
+    """
+
+    modules: Dict[str, ModuleStats]
+
+    def __init__(self, clock: Callable[[], float] = time.monotonic):
+        """
+        :param clock: The function returning the current time in seconds.
+        """
+        self.clock = clock
+        self.modules = {}
+        self._current: Optional[str] = None
+        self._started = 0.0
+
+    def feed(self, line: str) -> None:
+        """
+        Process a line of the output.
+
+        :param line: The line without the trailing newline.
+        """
+        m = BUILDING_RE.match(line)
+        if m:
+            self.finish()
+            self._current = m.group(1)
+            self._started = self.clock()
+            self.modules[self._current] = ModuleStats(CACHE_MISS, finished=False)
+            return
+
+        m = COMMITTING_RE.match(line)
+        if m and m.group(1) == self._current:
+            self.finish()
+            self.modules[m.group(1)].finished = True
+            return
+
+        m = CACHE_HIT_RE.match(line)
+        if m:
+            self.finish()
+            self.modules[m.group(1)] = ModuleStats(CACHE_HIT)
+
+    def finish(self) -> None:
+        """Stop measuring the module in progress."""
+        if self._current is not None:
+            self.modules[self._current].duration = self.clock() - self._started
+            self._current = None
+
+    def format_summary(self, top: int = None) -> str:
+        """
+        Format the modules sorted by duration, longest first.
+
+        :param top: The number of modules to show, all by default.
+        :return: Formatted summary.
+        """
+        modules = sorted(self.modules.items(), key=lambda item: item[1].duration, reverse=True)
+        misses = sum(1 for stats in self.modules.values() if stats.cache == CACHE_MISS)
+        lines = [f"{len(self.modules)} modules, {misses} cache misses, {len(self.modules) - misses} cache hits:"]
+        for name, stats in modules[:top]:
+            status = stats.cache if stats.finished else "unfinished"
+            lines.append(f"{name:<60} {status:>10} {stats.duration:>10.1f} s")
+        return "\n".join(lines)
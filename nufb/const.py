@@ -18,6 +18,27 @@ MANIFEST_APP_ID = "app-id"
 #: An array of objects specifying the modules to be built in order.
 MANIFEST_MODULES = "modules"
 
+#: The name of the runtime that the application uses.
+MANIFEST_RUNTIME = "runtime"
+
+#: The version of the runtime that the application uses, defaults to master.
+MANIFEST_RUNTIME_VERSION = "runtime-version"
+
+#: The name of the development runtime that the application builds with.
+MANIFEST_SDK = "sdk"
+
+#: Start with the files from the specified application. This can be used to
+#: create applications that extend another application.
+MANIFEST_BASE = "base"
+
+#: Use this specific version of the application specified in :data:`MANIFEST_BASE`.
+#: If unspecified, this uses the value specified in :data:`MANIFEST_BRANCH`.
+MANIFEST_BASE_VERSION = "base-version"
+
+#: Install these extra extensions from the :data:`MANIFEST_BASE` application
+#: when initializing the application directory.
+MANIFEST_BASE_EXTENSIONS = "base-extensions"
+
 #: The name of the module, used in e.g. build logs.
 MODULE_NAME = "name"
 
@@ -60,6 +81,21 @@ MODULE_SOURCES = "sources"
 
 MODULE_DISABLED = "disabled"
 
+#: The type of the source, e.g. :data:`SOURCE_TYPE_GIT`.
+SOURCE_TYPE = "type"
+
+#: The path of a local source, relative to the manifest.
+SOURCE_PATH = "path"
+
+#: The URL of a remote source.
+SOURCE_URL = "url"
+
+#: The :data:`SOURCE_TYPE` value for a git repository.
+SOURCE_TYPE_GIT = "git"
+
+#: The :data:`SOURCE_TYPE` values for sources backed by a single local file.
+SOURCE_TYPES_FILE = ("file", "patch", "archive")
+
 #: An array of commands to run during build (between make and make install
 #: if those are used).
 MODULE_BUILD_COMMANDS = "build-commands"
@@ -1,17 +1,29 @@
 #!/usr/bin/env python3
+import json
 import os
 import re
+import struct
 import sys
-from typing import Dict, List, Pattern, Set, Tuple
+from bisect import bisect_left
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Dict, Iterable, Iterator, List, Optional, Pattern, Set, Tuple, TypeVar
 
+T = TypeVar("T")
+WILDCARDS = "*?{"
+MODULE_COMMENT = "# module:"
+WALK_WORKERS = min(16, (os.cpu_count() or 1) + 4)
 
-def compile_pattern(pattern: str) -> Pattern[str]:
-    regex = ["^"]
+#: A file entry: path, device, inode, modification time in nanoseconds and size.
+Entry = Tuple[str, int, int, int, int]
+
+
+def translate_pattern(pattern: str) -> str:
+    regex = []
     group = 0
     for char in pattern:
         if char == "?":
             regex.append(".")
-        if char == "*":
+        elif char == "*":
             regex.append(".*")
         elif char == "{":
             group += 1
@@ -25,54 +37,305 @@ def compile_pattern(pattern: str) -> Pattern[str]:
         else:
             regex.append(re.escape(char))
 
-    regex.append("$")
     assert not group, group
-    return re.compile("".join(regex))
+    return "".join(regex)
+
+
+def compile_pattern(pattern: str) -> Pattern[str]:
+    return re.compile(translate_pattern(pattern))
+
+
+def literal_prefix(pattern: str) -> str:
+    """Return the literal directory part of the pattern before the first wildcard."""
+    end = min((i for i in map(pattern.find, WILDCARDS) if i >= 0), default=len(pattern))
+    return pattern[: pattern.rfind("/", 0, end) + 1]
+
+
+class PatternMatcher:
+    """
+    Match entries against a whole set of glob patterns at once.
+
+    Patterns are bucketed by their literal directory prefix and each bucket is compiled into a single regular
+    expression with a named group per pattern. An entry is therefore checked only against the buckets of its parent
+    directories, so the cost grows with the number of entries rather than entries × patterns. As with trying the
+    patterns one by one, a hit is attributed to the first pattern in the rule order.
+    """
+
+    counts: Dict[str, int]
+
+    def __init__(self) -> None:
+        self.counts = {}
+        self._patterns: List[str] = []
+        self._buckets: Optional[Dict[str, Pattern[str]]] = None
+
+    def __len__(self) -> int:
+        return len(self.counts)
+
+    def add(self, pattern: str) -> None:
+        if pattern not in self.counts:
+            self.counts[pattern] = 0
+            self._patterns.append(pattern)
+            self._buckets = None
+
+    def compile(self) -> Dict[str, Pattern[str]]:
+        alternatives: Dict[str, List[str]] = {}
+        for index, pattern in enumerate(self._patterns):
+            pattern = pattern.lstrip("@")
+            alternatives.setdefault(literal_prefix(pattern), []).append(f"(?P<p{index}>{translate_pattern(pattern)})")
+
+        self._buckets = {prefix: re.compile("|".join(regex)) for prefix, regex in alternatives.items()}
+        return self._buckets
+
+    def find(self, entry: str) -> Optional[str]:
+        """Return the first pattern matching the entry without counting the hit."""
+        buckets = self._buckets
+        if buckets is None:
+            buckets = self.compile()
+        if not buckets:
+            return None
+
+        best = len(self._patterns)
+        end = 0
+        while end >= 0:
+            regex = buckets.get(entry[:end])
+            if regex is not None:
+                m = regex.fullmatch(entry)
+                if m:
+                    best = min(best, int(m.lastgroup[1:]))  # type: ignore
+            end = entry.find("/", end) + 1 or -1
+
+        return self._patterns[best] if best < len(self._patterns) else None
+
+    def match(self, entry: str) -> Optional[str]:
+        """Return the first pattern matching the entry and count the hit."""
+        pattern = self.find(entry)
+        if pattern is not None:
+            self.counts[pattern] += 1
+        return pattern
+
+
+def iter_directory(directory: str) -> Iterator["os.DirEntry[str]"]:
+    """Iterate over items of a directory, reporting errors of listing it instead of raising them."""
+    try:
+        with os.scandir(directory) as it:
+            yield from it
+    except OSError as e:
+        print(f"Cannot list {directory}: {e}", file=sys.stderr)
+
+
+def scan_item(item: "os.DirEntry[str]", stat: bool, files: List[Entry], subdirs: List[str]) -> None:
+    """Add a directory item to files or subdirectories, reporting its errors instead of raising them."""
+    path = item.path[2:] if item.path.startswith("./") else item.path
+    try:
+        if item.is_dir():
+            if not item.is_symlink():
+                subdirs.append(item.path)
+        elif stat:
+            status = item.stat(follow_symlinks=False)
+            files.append((path, status.st_dev, status.st_ino, status.st_mtime_ns, status.st_size))
+        else:
+            files.append((path, 0, 0, 0, 0))
+    except FileNotFoundError:
+        print(f"Removed during scan: {path}", file=sys.stderr)
+    except OSError as e:
+        print(f"Cannot stat {path}: {e}", file=sys.stderr)
+        files.append((path, 0, 0, 0, 0))
+
+
+def scan_directory(directory: str, stat: bool = True) -> Tuple[List[Entry], List[str]]:
+    """
+    List a single directory.
+
+    Symbolic links to directories are treated like :func:`os.walk` with `followlinks=False` does: they are neither
+    followed nor reported as files. Unreadable directories are skipped. Errors of individual items are reported
+    and don't affect the other items: a file removed during the scan is left out and a file which cannot be
+    stat'ed is reported with zeroed status.
+
+    :param directory: The directory to list.
+    :param stat: Whether to fill in the file status or leave it zeroed.
+    :return: The files and subdirectories of the directory.
+    """
+    files: List[Entry] = []
+    subdirs: List[str] = []
+    for item in iter_directory(directory):
+        scan_item(item, stat, files, subdirs)
+    return files, subdirs
+
+
+def walk_entries(directory: str, stat: bool = True, workers: int = WALK_WORKERS) -> Iterator[Entry]:
+    """
+    Walk the directory tree with a pool of threads and yield files as soon as their directory is listed.
+
+    The order of entries is unspecified. Only the listings of directories which have not been yielded yet are held in
+    memory, so the caller decides whether the whole inventory is kept.
+
+    :param directory: The root directory.
+    :param stat: Whether to fill in the file status or leave it zeroed.
+    :param workers: The number of threads listing directories.
+    """
+    with ThreadPoolExecutor(workers) as executor:
+        pending = {executor.submit(scan_directory, directory, stat)}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                files, subdirs = future.result()
+                pending.update(executor.submit(scan_directory, subdir, stat) for subdir in subdirs)
+                yield from files
 
 
 def collect_entries(directory: str) -> List[str]:
-    return sorted(
-        os.path.join(root if not root.startswith("./") else root[2:], name) if root != "." else name
-        for root, _dirs, files in os.walk(directory, followlinks=False)
-        for name in files
-    )
+    return sorted(path for path, *_status in walk_entries(directory, stat=False))
+
+
+def tee(items: Iterable[T], into: List[T]) -> Iterator[T]:
+    """Pass items through while collecting them into a list."""
+    for item in items:
+        into.append(item)
+        yield item
+
 
+class Snapshot:
+    """
+    A compact binary inventory of files sorted by path.
 
-def read_rules(paths: Set[str], patterns: Dict[Tuple[str, Pattern[str]], int], file: str) -> None:
+    The file consists of a header, fixed-size records (path offset, path length, inode, mtime, size) and a blob of
+    encoded paths. The records are sorted by the encoded path, so entries are looked up by binary search without
+    parsing the whole file. The device is not stored as the tree is expected to stay on a single file system.
+    """
+
+    MAGIC = b"NUFBFL01"
+    HEADER = struct.Struct("<8sQ")
+    RECORD = struct.Struct("<QIQqq")
+
+    def __init__(self, data: bytes = b"") -> None:
+        self._data = data
+        self._count = 0
+        if data:
+            magic, self._count = self.HEADER.unpack_from(data)
+            if magic != self.MAGIC:
+                raise ValueError(f"Invalid snapshot header: {magic!r}")
+        self.seen = bytearray(self._count)
+
+    def __len__(self) -> int:
+        return self._count
+
+    def __getitem__(self, index: int) -> bytes:
+        offset, length = self.RECORD.unpack_from(self._data, self.HEADER.size + index * self.RECORD.size)[:2]
+        return self._data[offset : offset + length]
+
+    def find(self, path: str) -> Optional[Tuple[int, int, int]]:
+        """
+        Look up an entry and mark it as seen.
+
+        :param path: The path of the entry.
+        :return: The inode, mtime and size of the entry or `None` if it is not present.
+        """
+        key = os.fsencode(path)
+        index = bisect_left(self, key)
+        if index == self._count or self[index] != key:
+            return None
+        self.seen[index] = 1
+        _offset, _length, inode, mtime, size = self.RECORD.unpack_from(
+            self._data, self.HEADER.size + index * self.RECORD.size
+        )
+        return inode, mtime, size
+
+    def unseen(self) -> Iterator[str]:
+        """Iterate over entries that were not looked up with :meth:`find`."""
+        for index, seen in enumerate(self.seen):
+            if not seen:
+                yield os.fsdecode(self[index])
+
+    @classmethod
+    def load(cls, file: str) -> "Snapshot":
+        try:
+            with open(file, "rb") as f:
+                return cls(f.read())
+        except FileNotFoundError:
+            return cls()
+
+    @classmethod
+    def save(cls, file: str, entries: Iterable[Entry]) -> None:
+        records = sorted((os.fsencode(path), inode, mtime, size) for path, _device, inode, mtime, size in entries)
+        offset = cls.HEADER.size + len(records) * cls.RECORD.size
+        data = [cls.HEADER.pack(cls.MAGIC, len(records))]
+        for path, inode, mtime, size in records:
+            data.append(cls.RECORD.pack(offset, len(path), inode, mtime, size))
+            offset += len(path)
+        data.extend(record[0] for record in records)
+
+        with open(file + ".tmp", "wb") as f:
+            f.write(b"".join(data))
+        os.replace(file + ".tmp", file)
+
+
+def diff_entries(snapshot: Snapshot, entries: Iterable[Entry]) -> Tuple[List[str], List[str], List[str]]:
+    """
+    Compare current entries with a snapshot.
+
+    :param snapshot: The snapshot of the previous state.
+    :param entries: The current entries.
+    :return: Added, changed and removed paths.
+    """
+    added = []
+    changed = []
+    for path, _device, *status in entries:
+        previous = snapshot.find(path)
+        if previous is None:
+            added.append(path)
+        elif previous != tuple(status):
+            changed.append(path)
+
+    return added, changed, list(snapshot.unseen())
+
+
+def read_rules(paths: Set[str], patterns: PatternMatcher, file: str, owners: Optional[Dict[str, str]] = None) -> None:
+    """
+    Read exact paths and patterns from a rules file.
+
+    :param paths: Exact paths are added here.
+    :param patterns: Patterns are added here.
+    :param file: The rules file.
+    :param owners: If provided, rules following a `# module: name` comment are mapped to the module name here. A rule
+        repeated by another module stays owned by the first one and a warning is printed.
+    """
+    module = None
     with open(file) as f:
         for line in f:
             path = line.strip()
-            if path and not path.startswith("#"):
-                if "*" in path or "?" in path or "{" in path:
-                    patterns[(path, compile_pattern(path.lstrip("@")))] = 0
+            if path.startswith(MODULE_COMMENT):
+                module = path[len(MODULE_COMMENT) :].strip()
+            elif path and not path.startswith("#"):
+                if any(c in path for c in WILDCARDS):
+                    patterns.add(path)
                 else:
                     assert path not in paths
                     paths.add(path)
+                if owners is not None and module:
+                    owner = owners.setdefault(path, module)
+                    if owner != module:
+                        print(f"Rule {path} of module {module} is already owned by module {owner}.", file=sys.stderr)
 
 
-def process_entries(paths: Set[str], patterns: Dict[Tuple[str, Pattern[str]], int], entries: List[str]) -> List[str]:
+def process_entries(paths: Set[str], patterns: PatternMatcher, entries: Iterable[str]) -> List[str]:
     extra = []
 
     for entry in entries:
         try:
             paths.remove(entry)
         except KeyError:
-            for pattern in patterns:
-                if pattern[1].match(entry):
-                    patterns[pattern] += 1
-                    break
-            else:
+            if patterns.match(entry) is None:
                 extra.append(entry)
 
     return extra
 
 
-def print_summary(paths: Set[str], patterns: Dict[Tuple[str, Pattern[str]], int], extra: List[str]) -> bool:
+def print_summary(paths: Set[str], patterns: PatternMatcher, extra: List[str]) -> bool:
     success = not extra and not paths
 
     if extra:
         print("Extra entries:", file=sys.stderr)
-        for entry in extra:
+        for entry in sorted(extra):
             print("!", entry, file=sys.stderr)
 
     if paths:
@@ -81,7 +344,7 @@ def print_summary(paths: Set[str], patterns: Dict[Tuple[str, Pattern[str]], int]
             print("!", entry, file=sys.stderr)
     if patterns:
         print("Patterns:", file=sys.stderr)
-        for (pattern, _matcher), count in patterns.items():
+        for pattern, count in patterns.counts.items():
             if not count and not pattern.startswith("@"):
                 success = False
                 print("!", pattern, count, file=sys.stderr)
@@ -91,19 +354,99 @@ def print_summary(paths: Set[str], patterns: Dict[Tuple[str, Pattern[str]], int]
     return success
 
 
+def check_snapshot(directory: str, snapshot_file: str, paths: Set[str], patterns: PatternMatcher) -> bool:
+    """
+    Check only the entries added since the snapshot was taken and update it.
+
+    Added entries must match the rules and only they count towards pattern hits, as with the full check against the
+    previous listing. Changed entries were already accepted before. Removed entries are reported as unused paths.
+    """
+    entries: List[Entry] = []
+    added, _changed, removed = diff_entries(Snapshot.load(snapshot_file), tee(walk_entries(directory), entries))
+    extra = process_entries(paths, patterns, added)
+    paths.update(removed)
+    success = print_summary(paths, patterns, extra)
+    if success:
+        Snapshot.save(snapshot_file, entries)
+    return success
+
+
+def measure_entries(
+    paths: Set[str], patterns: PatternMatcher, owners: Dict[str, str], entries: Iterable[Entry]
+) -> Dict[str, dict]:
+    """
+    Sum up the size of entries per rule and per module owning the rule.
+
+    Hard links are counted only once, for the first path seen. Entries with an unknown inode are never treated as hard
+    links.
+
+    :param paths: Exact paths.
+    :param patterns: Patterns.
+    :param owners: The mapping of rules to modules.
+    :param entries: The entries to measure.
+    :return: Files and bytes in total, per module and per rule.
+    """
+    total = {"files": 0, "bytes": 0}
+    modules: Dict[str, Dict[str, int]] = {}
+    rules: Dict[str, Dict[str, int]] = {}
+    inodes: Set[Tuple[int, int]] = set()
+
+    for path, device, inode, _mtime, size in sorted(entries):
+        rule = path if path in paths else patterns.find(path)
+        if rule is None:
+            continue
+        if inode:
+            if (device, inode) in inodes:
+                size = 0
+            else:
+                inodes.add((device, inode))
+
+        counters = [total, rules.setdefault(rule, {"files": 0, "bytes": 0})]
+        if rule in owners:
+            counters.append(modules.setdefault(owners[rule], {"files": 0, "bytes": 0}))
+        for counter in counters:
+            counter["files"] += 1
+            counter["bytes"] += size
+
+    def by_size(items: Dict[str, Dict[str, int]]) -> Dict[str, Dict[str, int]]:
+        return dict(sorted(items.items(), key=lambda item: item[1]["bytes"], reverse=True))
+
+    return {"total": total, "modules": by_size(modules), "rules": by_size(rules)}
+
+
 def main(argv: List[str]) -> int:
-    directory = argv[1] if len(argv) > 1 else "."
-    entries = collect_entries(directory)
-    print("\n".join(entries), file=sys.stdout)
+    options = {}
+    while len(argv) > 2 and argv[1].startswith("--"):
+        options[argv[1][2:]] = argv[2]
+        argv = argv[:1] + argv[3:]
 
-    patterns = {}
-    paths = set()
+    directory = argv[1] if len(argv) > 1 else "."
+    patterns = PatternMatcher()
+    paths: Set[str] = set()
+    owners: Dict[str, str] = {}
 
     for file in argv[2:]:
-        read_rules(paths, patterns, file)
+        read_rules(paths, patterns, file, owners)
 
-    extra = process_entries(paths, patterns, entries)
-    success = print_summary(paths, patterns, extra)
+    if "snapshot" in options:
+        success = check_snapshot(directory, options["snapshot"], paths, patterns)
+    else:
+        sizes_file = options.get("sizes")
+        exact = set(paths)
+        # Only the paths are kept for the sorted listing unless the sizes are measured.
+        walk = walk_entries(directory, stat=sizes_file is not None)
+        entries: List[Entry] = []
+        if sizes_file:
+            walk = tee(walk, entries)
+        listing: List[str] = []
+        extra = process_entries(paths, patterns, tee((e[0] for e in walk), listing))
+        listing.sort()
+        sys.stdout.writelines(f"{path}\n" for path in listing)
+        success = print_summary(paths, patterns, extra)
+        if sizes_file:
+            with open(sizes_file, "w") as f:
+                json.dump(measure_entries(exact, patterns, owners, entries), f, indent=2)
+                f.write("\n")
     return 0 if success else 1
 
 
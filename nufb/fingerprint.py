@@ -0,0 +1,82 @@
+# Copyright 2019-2020 Jiří Janoušek <janousek.jiri@gmail.com>
+# License: BSD-2-Clause, see file LICENSE at the project root.
+"""
+Fingerprints of build inputs to skip builds when nothing has changed.
+"""
+import asyncio
+import hashlib
+import json
+import os
+from pathlib import Path
+from typing import Optional
+
+from aiofiles.os import wrap
+
+from nufb.git import get_git_head
+from nufb.logging import get_logger
+from nufb.manifest import Manifest
+from nufb.utils import exec_subprocess
+
+LOGGER = get_logger(__name__)
+
+
+def _hash_file(path: Path) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as fh:
+        for chunk in iter(lambda: fh.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+hash_file = wrap(_hash_file)
+
+
+async def get_installed_commit(ref: str) -> Optional[str]:
+    """
+    Get the commit of an installed flatpak.
+
+    :param ref: The flatpak ref, e.g. `org.gnome.Sdk//40`.
+    :return: The commit hash or `None` if it is not installed.
+    """
+    argv = ["flatpak", "info", "--show-commit", ref]
+    code, out = await exec_subprocess(argv)
+    if code:
+        LOGGER.warning("%s returned %d.\n%s", argv, code, out)
+        return None
+    return out.strip()
+
+
+async def compute_fingerprint(manifest: Manifest, resources_dir: Path) -> Optional[str]:
+    """
+    Compute the fingerprint of all inputs of a build.
+
+    The fingerprint covers the rendered manifest, the content of local files, the current commits of git sources
+    and the installed commits of the SDK, runtime, base and base extensions. Git sources pinned to a commit by
+    :meth:`Manifest.pin_git_source` are resolved upstream, so that a pin doesn't hide new commits.
+
+    :param manifest: The manifest to build.
+    :param resources_dir: The directory containing build resources.
+    :return: The fingerprint or `None` if some inputs cannot be resolved.
+    :raise OSError: When a local file cannot be read.
+    """
+    refs = [f"{flatpak_id}//{version}" for flatpak_id, version in manifest.required_refs()]
+    files = sorted(set(manifest.local_files()))
+    try:
+        file_hashes, git_heads, commits = await asyncio.gather(
+            asyncio.gather(*(hash_file(path if os.path.isabs(path) else resources_dir / path) for path in files)),
+            asyncio.gather(*map(get_git_head, manifest.upstream_git_sources())),
+            asyncio.gather(*map(get_installed_commit, refs)),
+        )
+    except FileNotFoundError as e:
+        LOGGER.warning("Cannot compute fingerprint of %s.", manifest.id, exc_info=e)
+        return None
+
+    if None in git_heads or None in commits:
+        return None
+
+    digest = hashlib.sha256()
+    digest.update(json.dumps(manifest.data, sort_keys=True).encode("utf-8"))
+    digest.update(json.dumps(list(zip(files, file_hashes))).encode("utf-8"))
+    digest.update(json.dumps(list(zip(refs, commits))).encode("utf-8"))
+    digest.update(json.dumps(git_heads).encode("utf-8"))
+    return digest.hexdigest()
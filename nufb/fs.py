@@ -24,5 +24,8 @@ rmtree = wrap(shutil.rmtree)
 copy = wrap(shutil.copy2)
 symlink = wrap(os.symlink)
 isdir = wrap(os.path.isdir)
+isfile = wrap(os.path.isfile)
+rename = wrap(os.rename)
+stat = wrap(os.stat)
 
-__all__ = ["open", "remove", "rmtree", "makedirs", "hardlink", "copy", "symlink", "isdir"]
+__all__ = ["open", "remove", "rmtree", "makedirs", "hardlink", "copy", "symlink", "isdir", "isfile", "rename", "stat"]
@@ -0,0 +1,139 @@
+# Copyright 2019-2020 Jiří Janoušek <janousek.jiri@gmail.com>
+# License: BSD-2-Clause, see file LICENSE at the project root.
+"""
+Git sources and their mirrors in the flatpak-builder state.
+"""
+import os
+from contextlib import suppress
+from pathlib import Path
+from typing import Optional
+
+from nufb import const, fs
+from nufb.logging import get_logger
+from nufb.utils import exec_subprocess
+
+LOGGER = get_logger(__name__)
+
+
+def get_git_url(source: dict) -> Optional[str]:
+    """
+    Get the URL flatpak-builder mirrors a git source from.
+
+    :param source: The git source.
+    :return: The URL or `None` for a relative path.
+    """
+    url = source.get(const.SOURCE_URL)
+    if url:
+        return url
+    path = source.get(const.SOURCE_PATH)
+    return Path(path).as_uri() if path and os.path.isabs(path) else None
+
+
+def get_git_ref(source: dict) -> str:
+    """
+    Get the ref a git source is built from.
+
+    :param source: The git source.
+    :return: A full ref name or `HEAD`.
+    """
+    if "tag" in source:
+        return f"refs/tags/{source['tag']}"
+    if "branch" in source:
+        return f"refs/heads/{source['branch']}"
+    return "HEAD"
+
+
+def get_git_mirror_name(url: str) -> str:
+    """
+    Get the name of the git mirror as flatpak-builder does (`builder_uri_to_filename`).
+
+    :param url: The URL of the repository.
+    :return: The name of the mirror directory.
+    """
+    name = []
+    saw_slash = saw_after_slash = False
+    for char in url:
+        if char == "/":
+            saw_slash = True
+            # Skip the first slashes
+            if saw_after_slash:
+                name.append("_")
+        else:
+            saw_after_slash = saw_after_slash or saw_slash
+            name.append(char)
+    return "".join(name)
+
+
+async def get_git_head(source: dict) -> Optional[str]:
+    """
+    Resolve the commit a git source currently points to.
+
+    :param source: The git source.
+    :return: The commit hash or `None` if it cannot be resolved.
+    """
+    if "commit" in source:
+        return source["commit"]
+
+    ref = get_git_ref(source)
+    location = source.get(const.SOURCE_URL) or source.get(const.SOURCE_PATH)
+    if not location:
+        LOGGER.warning("Git source has neither url nor path: %s", source)
+        return None
+
+    argv = ["git", "ls-remote", location, ref]
+    code, out = await exec_subprocess(argv)
+    if code:
+        LOGGER.warning("%s returned %d.\n%s", argv, code, out)
+        return None
+
+    for line in out.splitlines():
+        commit, _, name = line.partition("\t")
+        if name == ref:
+            return commit
+    return None
+
+
+async def update_mirror(url: str, git_dir: Path) -> Path:
+    """
+    Create or update a bare mirror of a git repository.
+
+    :param url: The URL of the repository.
+    :param git_dir: The `git` directory of flatpak-builder state.
+    :return: The path of the mirror.
+    :raise ValueError: On failure.
+    """
+    mirror = git_dir / get_git_mirror_name(url)
+    if await fs.isdir(mirror):
+        argv = ["git", "-C", str(mirror), "fetch", "--prune", "--tags", "origin"]
+    else:
+        tmp = git_dir / (mirror.name + ".tmp")
+        with suppress(FileNotFoundError):
+            await fs.rmtree(tmp)
+        await fs.makedirs(git_dir, exist_ok=True)
+        argv = ["git", "clone", "--mirror", url, str(tmp)]
+
+    LOGGER.info("Updating git mirror of %s.", url)
+    code, out = await exec_subprocess(argv)
+    if code:
+        LOGGER.error("%s returned %d.\n%s", argv, code, out)
+        raise ValueError(code)
+    if not await fs.isdir(mirror):
+        await fs.rename(tmp, mirror)
+    return mirror
+
+
+async def resolve_mirror_commit(mirror: Path, ref: str) -> str:
+    """
+    Resolve a ref in a git mirror to a commit.
+
+    :param mirror: The path of the mirror.
+    :param ref: The ref to resolve.
+    :return: The commit hash.
+    :raise ValueError: On failure.
+    """
+    argv = ["git", "-C", str(mirror), "rev-parse", "--verify", f"{ref}^{{commit}}"]
+    code, out = await exec_subprocess(argv)
+    if code:
+        LOGGER.error("%s returned %d.\n%s", argv, code, out)
+        raise ValueError(code)
+    return out.strip()
@@ -0,0 +1,144 @@
+# Copyright 2019-2020 Jiří Janoušek <janousek.jiri@gmail.com>
+# License: BSD-2-Clause, see file LICENSE at the project root.
+"""
+History of builds in a SQLite database and predictions of their durations.
+"""
+import sqlite3
+from contextlib import closing
+from pathlib import Path
+from statistics import median
+from typing import Dict, Iterable, NamedTuple, Optional
+
+from aiofiles.os import wrap
+
+from nufb.buildlog import ModuleStats
+
+#: The database file in the build root.
+HISTORY_FILE = "history.sqlite"
+
+#: The build was exported to the repository.
+OUTCOME_EXPORTED = "exported"
+#: The build finished but export was disabled.
+OUTCOME_BUILT = "built"
+#: The build finished without changes, there was nothing to export.
+OUTCOME_UNCHANGED = "unchanged"
+#: The build was skipped because its inputs haven't changed since the last export.
+OUTCOME_SKIPPED = "skipped"
+#: The build failed.
+OUTCOME_FAILED = "failed"
+#: Outcomes of builds which ran to the end and predict durations of future builds.
+OUTCOMES_FINISHED = (OUTCOME_EXPORTED, OUTCOME_BUILT, OUTCOME_UNCHANGED)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS builds (
+    id INTEGER PRIMARY KEY,
+    manifest TEXT NOT NULL,
+    branch TEXT NOT NULL,
+    started REAL NOT NULL,
+    duration REAL NOT NULL,
+    outcome TEXT NOT NULL,
+    commit_id TEXT,
+    size INTEGER
+);
+CREATE INDEX IF NOT EXISTS builds_manifest ON builds (manifest, branch, started);
+CREATE TABLE IF NOT EXISTS phases (
+    build INTEGER NOT NULL REFERENCES builds (id) ON DELETE CASCADE,
+    phase TEXT NOT NULL,
+    duration REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS modules (
+    build INTEGER NOT NULL REFERENCES builds (id) ON DELETE CASCADE,
+    module TEXT NOT NULL,
+    cache TEXT NOT NULL,
+    duration REAL NOT NULL,
+    finished INTEGER NOT NULL
+);
+"""
+
+
+class PlannedBuild(NamedTuple):
+    name: str
+    duration: Optional[float]
+    up_to_date: bool
+    critical_path: float
+
+
+def _connect(path: Path) -> sqlite3.Connection:
+    path.parent.mkdir(parents=True, exist_ok=True)
+    connection = sqlite3.connect(str(path), timeout=60)
+    connection.executescript(SCHEMA)
+    return connection
+
+
+def _record_build(
+    path: Path,
+    manifest_id: str,
+    branch: str,
+    started: float,
+    duration: float,
+    outcome: str,
+    phases: Dict[str, float],
+    commit: Optional[str] = None,
+    size: Optional[int] = None,
+    modules: Dict[str, ModuleStats] = None,
+) -> None:
+    with closing(_connect(path)) as connection, connection:
+        cursor = connection.execute(
+            "INSERT INTO builds (manifest, branch, started, duration, outcome, commit_id, size)"
+            " VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (manifest_id, branch, started, duration, outcome, commit, size),
+        )
+        connection.executemany(
+            "INSERT INTO phases (build, phase, duration) VALUES (?, ?, ?)",
+            ((cursor.lastrowid, phase, phase_duration) for phase, phase_duration in phases.items()),
+        )
+        connection.executemany(
+            "INSERT INTO modules (build, module, cache, duration, finished) VALUES (?, ?, ?, ?, ?)",
+            (
+                (cursor.lastrowid, module, stats.cache, stats.duration, stats.finished)
+                for module, stats in (modules or {}).items()
+            ),
+        )
+
+
+def _predict_duration(path: Path, manifest_id: str, branch: str, samples: int = 5) -> Optional[float]:
+    if not path.is_file():
+        return None
+    with closing(_connect(path)) as connection:
+        rows = connection.execute(
+            f"SELECT duration FROM builds WHERE manifest = ? AND branch = ?"
+            f" AND outcome IN ({', '.join('?' * len(OUTCOMES_FINISHED))}) ORDER BY started DESC LIMIT ?",
+            (manifest_id, branch, *OUTCOMES_FINISHED, samples),
+        ).fetchall()
+    return median(row[0] for row in rows) if rows else None
+
+
+#: Record a build. See :func:`_record_build` for parameters.
+record_build = wrap(_record_build)
+#: Predict the duration of a build as the median of its last finished builds or `None` if there are none.
+predict_duration = wrap(_predict_duration)
+
+
+def format_duration(duration: Optional[float]) -> str:
+    if duration is None:
+        return "?"
+    minutes, seconds = divmod(round(duration), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours}:{minutes:02}:{seconds:02}" if hours else f"{minutes}:{seconds:02}"
+
+
+def format_plan(builds: Iterable[PlannedBuild]) -> str:
+    """
+    Format a plan of builds.
+
+    :param builds: The builds in the order they would start.
+    :return: Formatted plan with the estimated duration of the critical path.
+    """
+    lines = [f"{'Build':<60} {'Duration':>12} {'Critical path':>14}"]
+    eta = 0.0
+    for build in builds:
+        status = "up to date" if build.up_to_date else format_duration(build.duration)
+        lines.append(f"{build.name:<60} {status:>12} {format_duration(build.critical_path):>14}")
+        eta = max(eta, build.critical_path)
+    lines.append(f"{'ETA':<60} {'':>12} {format_duration(eta):>14}")
+    return "\n".join(lines)
@@ -1,4 +1,4 @@
-from typing import Any, Dict, List, Union, cast
+from typing import Any, Dict, Iterator, List, Tuple, Union, cast
 
 from nufb import const
 from nufb.utils import get_data_path
@@ -17,6 +17,8 @@ FILE_CHECK_MODULE = {
 
 class Manifest:
     modules: Dict[str, dict]
+    #: Original git sources pinned by :meth:`pin_git_source`, keyed by the id of the pinned source.
+    pinned_sources: Dict[int, dict]
 
     def __init__(
         self,
@@ -31,6 +33,7 @@ class Manifest:
         if modules is None:
             self.data[const.MANIFEST_MODULES] = modules = []
         self.modules = {cast(str, m[const.MODULE_NAME]): m for m in modules if isinstance(m, dict)}
+        self.pinned_sources = {}
 
         if self.data.setdefault(const.MANIFEST_BRANCH, branch) != branch:
             raise ValueError(f"Wrong branch in manifest: {self.data[const.MANIFEST_BRANCH]}")
@@ -45,6 +48,25 @@ class Manifest:
         """
         return self.data[const.MANIFEST_APP_ID]
 
+    def required_refs(self) -> List[Tuple[str, str]]:
+        """
+        Get flatpaks the build depends on: SDK, runtime, base and base extensions.
+
+        :return: A list of flatpak ids and versions.
+        """
+        refs = []
+        runtime_version = self.data.get(const.MANIFEST_RUNTIME_VERSION, const.MANIFEST_BRANCH_DEFAULT)
+        for key in const.MANIFEST_SDK, const.MANIFEST_RUNTIME:
+            if key in self.data:
+                refs.append((self.data[key], runtime_version))
+
+        base = self.data.get(const.MANIFEST_BASE)
+        if base:
+            base_version = self.data.get(const.MANIFEST_BASE_VERSION, self.branch)
+            refs.append((base, base_version))
+            refs.extend((extension, base_version) for extension in self.data.get(const.MANIFEST_BASE_EXTENSIONS, []))
+        return refs
+
     def sources(self, module_name: str, create: bool = True) -> List[Union[str, dict]]:
         module = self.modules[module_name]
         sources = module.get(const.MODULE_SOURCES)
@@ -56,6 +78,65 @@ class Manifest:
 
         return sources
 
+    def enabled_sources(self) -> Iterator[Union[str, dict]]:
+        """Iterate over sources of enabled modules."""
+        for name, module in self.modules.items():
+            if not module.get(const.MODULE_DISABLED):
+                yield from self.sources(name, create=False)
+
+    def local_files(self) -> Iterator[str]:
+        """
+        Iterate over paths of local files referenced by sources of enabled modules.
+
+        :return: Relative or absolute paths.
+        """
+        for source in self.enabled_sources():
+            if isinstance(source, str):
+                path = source
+            elif source[const.SOURCE_TYPE] in const.SOURCE_TYPES_FILE:
+                path = source.get(const.SOURCE_PATH, "")
+            else:
+                continue
+
+            if path:
+                yield path
+
+    def remote_files(self) -> Iterator[dict]:
+        """Iterate over sources of enabled modules that download a single file."""
+        for source in self.enabled_sources():
+            if (
+                isinstance(source, dict)
+                and source[const.SOURCE_TYPE] in const.SOURCE_TYPES_FILE
+                and const.SOURCE_URL in source
+            ):
+                yield source
+
+    def git_sources(self) -> Iterator[dict]:
+        """Iterate over git sources of enabled modules."""
+        for source in self.enabled_sources():
+            if isinstance(source, dict) and source[const.SOURCE_TYPE] == const.SOURCE_TYPE_GIT:
+                yield source
+
+    def upstream_git_sources(self) -> Iterator[dict]:
+        """Iterate over git sources of enabled modules as they were before :meth:`pin_git_source`."""
+        for source in self.git_sources():
+            yield self.pinned_sources.get(id(source), source)
+
+    def pin_git_source(self, source: dict, commit: str) -> None:
+        """
+        Pin a git source to a commit.
+
+        The branch or tag of the source is replaced with the commit, so that flatpak-builder doesn't require the commit
+        to be the current tip of the branch. The original source is still available from :meth:`upstream_git_sources`.
+
+        :param source: A git source of the manifest.
+        :param commit: The commit to build.
+        """
+        self.pinned_sources[id(source)] = dict(source)
+        source.pop("branch", None)
+        source.pop("tag", None)
+        source["commit"] = commit
+
     def process_stage_keep_rules(self) -> None:
         keep_files = ["/app/lib/debug/*"]
         last_module = self.data[const.MANIFEST_MODULES][-1]
@@ -75,13 +156,14 @@ class Manifest:
             stage.append("@/app/lib/debug/*")
             keep = module.pop(const.KEEP_PATTERNS, [])
             stage += keep
-            keep_files += keep
+            if keep:
+                keep_files.append(f"# module: {name}")
+                keep_files += keep
 
             if module != last_module:
                 post_install.append(
                     "cd /app/lib/debug/filelist && "  # noqa: SC300
-                    "./filelist /app $FLATPAK_BUILDER_BUILDDIR/allowed latest > current && "  # noqa: SC300
-                    "mv current latest"  # noqa: SC300
+                    "./filelist --snapshot snapshot /app $FLATPAK_BUILDER_BUILDDIR/allowed"  # noqa: SC300
                 )
 
                 sources.append(
@@ -94,8 +176,9 @@ class Manifest:
             else:
                 post_install.append(  # noqa: SC300
                     "cd /app/lib/debug/filelist && "
-                    "rm latest && "
-                    "./filelist /app $FLATPAK_BUILDER_BUILDDIR/allowed /dev/null > latest"  # noqa: SC300
+                    "rm -f latest snapshot && "
+                    "./filelist --sizes sizes.json /app "
+                    "$FLATPAK_BUILDER_BUILDDIR/allowed /dev/null > latest"  # noqa: SC300
                 )
 
                 sources.append(
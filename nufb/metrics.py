@@ -0,0 +1,182 @@
+# Copyright 2019-2020 Jiří Janoušek <janousek.jiri@gmail.com>
+# License: BSD-2-Clause, see file LICENSE at the project root.
+"""
+Metrics of builds in the Prometheus textfile format.
+
+Metrics are disabled by default and updates are no-ops until :func:`enable_metrics` is called. Updates made within
+an interval are coalesced into a single write of the file outside the event loop. The file is replaced atomically,
+so the textfile collector of a node exporter always reads a consistent state.
+"""
+import asyncio
+import os
+import time
+from pathlib import Path
+from typing import Dict, Optional, Tuple
+
+from aiofiles.os import wrap
+
+from nufb.logging import get_logger
+
+LOGGER = get_logger(__name__)
+
+#: Names of metrics and their types and descriptions.
+DEFINITIONS = {
+    "nufb_builds": ("gauge", "Builds queued or running."),
+    "nufb_builds_done_total": ("counter", "Builds done by outcome."),
+    "nufb_lock_waiting": ("gauge", "Tasks waiting for a lock."),
+    "nufb_lock_wait_seconds_total": ("counter", "Time spent waiting for a lock."),
+    "nufb_session_holders": ("gauge", "Builds holding a slot of the concurrency limit of a build session."),
+    "nufb_subprocesses_running": ("gauge", "Subprocesses running."),
+    "nufb_subprocesses_total": ("counter", "Subprocesses started."),
+    "nufb_exported_bytes_total": ("counter", "Size of builds exported to the repository."),
+    "nufb_last_update_timestamp_seconds": ("gauge", "Time of the last update of metrics."),
+}
+#: Labeled series present from the start, so that dashboards show zeros rather than no data.
+INITIAL = [
+    *(("nufb_builds", (("state", state),)) for state in ("queued", "running")),
+    *(
+        (name, (("lock", lock),))
+        for name in ("nufb_lock_waiting", "nufb_lock_wait_seconds_total")
+        for lock in ("download", "build", "export", "install")
+    ),
+    ("nufb_session_holders", ()),
+    ("nufb_subprocesses_running", ()),
+    ("nufb_subprocesses_total", ()),
+    ("nufb_exported_bytes_total", ()),
+]
+
+Labels = Tuple[Tuple[str, str], ...]
+
+
+def _replace_file(path: Path, text: str) -> None:
+    tmp = path.with_name(path.name + ".tmp")
+    tmp.write_text(text)
+    os.replace(tmp, path)
+
+
+#: Replace the content of a file atomically.
+replace_file = wrap(_replace_file)
+
+
+class Metrics:
+    path: Path
+    interval: float
+    values: Dict[Tuple[str, Labels], float]
+
+    def __init__(self, path: Path, interval: float = 1.0):
+        """
+        :param path: The file to write metrics to, e.g. `nufb.prom` in the directory of the textfile collector.
+        :param interval: The delay of writing updates made in the event loop, in seconds.
+        """
+        self.path = path
+        self.interval = interval
+        self.values = dict.fromkeys(INITIAL, 0.0)
+        self._scheduled = False
+        self._writing: Optional[asyncio.Future] = None
+
+    def add(self, name: str, amount: float, labels: Labels) -> None:
+        key = name, labels
+        self.values[key] = self.values.get(key, 0.0) + amount
+        self.schedule_write()
+
+    def schedule_write(self) -> None:
+        """
+        Write metrics after the interval if the event loop is running, right away otherwise.
+
+        :raise OSError: When the metrics are written right away and a filesystem operation fails.
+        """
+        if self._scheduled:
+            return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            self.write()
+            return
+        self._scheduled = True
+        loop.call_later(self.interval, self._write_in_background)
+
+    def _write_in_background(self) -> None:
+        self._scheduled = False
+        if self._writing is not None and not self._writing.done():
+            # Don't let an older write finish after a newer one.
+            self.schedule_write()
+            return
+        self._writing = asyncio.ensure_future(replace_file(self.path, self.render()))
+        self._writing.add_done_callback(self._check_write)
+
+    @staticmethod
+    def _check_write(future: asyncio.Future) -> None:
+        if not future.cancelled() and future.exception() is not None:
+            LOGGER.warning("Failed to write metrics: %s", future.exception())
+
+    def render(self) -> str:
+        """
+        Render metrics in the text exposition format.
+
+        :return: Rendered metrics.
+        """
+        self.values["nufb_last_update_timestamp_seconds", ()] = time.time()
+        lines = []
+        for name, (kind, description) in DEFINITIONS.items():
+            lines.append(f"# HELP {name} {description}")
+            lines.append(f"# TYPE {name} {kind}")
+            for (series, labels), value in sorted(self.values.items()):
+                if series == name:
+                    rendered = ",".join(f'{label}="{label_value}"' for label, label_value in labels)
+                    lines.append(f"{name}{{{rendered}}} {value!r}" if labels else f"{name} {value!r}")
+        return "\n".join(lines) + "\n"
+
+    def write(self) -> None:
+        """
+        Write metrics to the file atomically and block until it is done.
+
+        :raise OSError: When a filesystem operation fails.
+        """
+        _replace_file(self.path, self.render())
+
+
+METRICS: Optional[Metrics] = None
+
+
+def enable_metrics(path: Path) -> None:
+    """
+    Start exporting metrics.
+
+    :param path: The file to write metrics to.
+    """
+    global METRICS
+    METRICS = Metrics(path)
+    METRICS.write()
+
+
+def flush() -> None:
+    """
+    Write metrics right away, e.g. when updates written later would be lost because the event loop has finished.
+
+    :raise OSError: When a filesystem operation fails.
+    """
+    if METRICS is not None:
+        METRICS.write()
+
+
+def inc(name: str, amount: float = 1.0, **labels: str) -> None:
+    """
+    Increase a counter or a gauge.
+
+    :param name: The name of the metric.
+    :param amount: The amount to add, negative to decrease a gauge.
+    :param labels: Labels of the series.
+    """
+    if METRICS is not None:
+        METRICS.add(name, amount, tuple(sorted(labels.items())))
+
+
+def dec(name: str, amount: float = 1.0, **labels: str) -> None:
+    """
+    Decrease a gauge.
+
+    :param name: The name of the metric.
+    :param amount: The amount to subtract.
+    :param labels: Labels of the series.
+    """
+    inc(name, -amount, **labels)
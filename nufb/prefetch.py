@@ -0,0 +1,128 @@
+# Copyright 2019-2020 Jiří Janoušek <janousek.jiri@gmail.com>
+# License: BSD-2-Clause, see file LICENSE at the project root.
+"""
+Prefetching of sources into the shared flatpak-builder state before builds start.
+
+The layout of the state directory follows flatpak-builder, so its download step finds the sources in place:
+archives and files are stored as `downloads/<sha256>/<basename of URL>` and git repositories as bare mirrors in
+`git/<URL with slashes replaced by underscores>`.
+"""
+import asyncio
+import hashlib
+import os
+import urllib.request
+from contextlib import suppress
+from os.path import basename
+from pathlib import Path
+from typing import Dict, Iterable
+from urllib.parse import urlparse
+
+from aiofiles.os import wrap
+
+from nufb import const, fs
+from nufb.git import get_git_url, update_mirror
+from nufb.logging import get_logger
+from nufb.manifest import Manifest
+
+LOGGER = get_logger(__name__)
+
+
+#: Seconds to wait for a connection or data from a server before a download attempt fails.
+DOWNLOAD_TIMEOUT = 60
+#: The number of download attempts per URL.
+DOWNLOAD_ATTEMPTS = 3
+
+
+def _fetch(url: str, destination: Path) -> str:
+    digest = hashlib.sha256()
+    with urllib.request.urlopen(url, timeout=DOWNLOAD_TIMEOUT) as response, open(destination, "wb") as fh:  # noqa: S310
+        for chunk in iter(lambda: response.read(1024 * 1024), b""):
+            digest.update(chunk)
+            fh.write(chunk)
+    return digest.hexdigest()
+
+
+def _download(urls: Iterable[str], sha256: str, destination: Path) -> None:
+    tmp = destination.with_name(destination.name + ".part")
+    for url in urls:
+        for attempt in range(1, DOWNLOAD_ATTEMPTS + 1):
+            try:
+                checksum = _fetch(url, tmp)
+            except OSError as e:
+                LOGGER.warning("Failed to download %s (attempt %d of %d).", url, attempt, DOWNLOAD_ATTEMPTS, exc_info=e)
+                continue
+
+            if checksum == sha256:
+                os.replace(tmp, destination)
+                return
+            LOGGER.warning("Wrong checksum of %s: %s != %s", url, checksum, sha256)
+            break
+
+    with suppress(FileNotFoundError):
+        os.remove(tmp)
+    raise OSError(f"Failed to download {destination.name}.")
+
+
+#: Download a file from the first URL with the right checksum, retrying each URL on network errors.
+download = wrap(_download)
+
+
+def collect_sources(manifests: Iterable[Manifest]) -> Dict[str, dict]:
+    """
+    Collect remote sources of manifests deduplicated by their URL and checksum.
+
+    :param manifests: The manifests.
+    :return: Remote files keyed by `sha256` and git sources keyed by URL.
+    """
+    sources: Dict[str, dict] = {}
+    for manifest in manifests:
+        for source in manifest.remote_files():
+            if "sha256" in source:
+                sources.setdefault(f"{source['sha256']}/{basename(urlparse(source['url']).path)}", source)
+        for source in manifest.git_sources():
+            url = get_git_url(source)
+            if url:
+                sources.setdefault(url, source)
+    return sources
+
+
+async def prefetch_file(source: dict, downloads_dir: Path) -> None:
+    """
+    Download an archive or file unless it is already present.
+
+    :param source: The source.
+    :param downloads_dir: The `downloads` directory of flatpak-builder state.
+    :raise OSError: On failure.
+    """
+    url = source[const.SOURCE_URL]
+    destination = downloads_dir / source["sha256"] / basename(urlparse(url).path)
+    if await fs.isfile(destination):
+        return
+    await fs.makedirs(destination.parent, exist_ok=True)
+    LOGGER.info("Prefetching %s.", url)
+    await download([url, *source.get("mirror-urls", [])], source["sha256"], destination)
+
+
+async def prefetch_sources(manifests: Iterable[Manifest], state_dir: Path, jobs: int = 8) -> None:
+    """
+    Fetch all remote sources of manifests into the flatpak-builder state with a bounded pool.
+
+    Failures are only logged, the download step of the affected build will try again and report the error.
+
+    :param manifests: The manifests to prefetch sources for.
+    :param state_dir: The shared flatpak-builder state directory.
+    :param jobs: The number of concurrent downloads.
+    """
+    semaphore = asyncio.BoundedSemaphore(jobs)
+
+    async def task(key: str, source: dict) -> None:
+        async with semaphore:
+            try:
+                if source[const.SOURCE_TYPE] == const.SOURCE_TYPE_GIT:
+                    await update_mirror(key, state_dir / "git")
+                else:
+                    await prefetch_file(source, state_dir / "downloads")
+            except (OSError, ValueError) as e:
+                LOGGER.warning("Failed to prefetch %s.", key, exc_info=e)
+
+    await asyncio.gather(*(task(key, source) for key, source in collect_sources(manifests).items()))
@@ -0,0 +1,155 @@
+# Copyright 2019-2020 Jiří Janoušek <janousek.jiri@gmail.com>
+# License: BSD-2-Clause, see file LICENSE at the project root.
+"""
+Incremental publishing of the repository to a mirror directory.
+
+Objects, static deltas and indexed summaries are immutable and named by their checksums, so only those missing
+in the mirror are copied. Detached commit metadata (`.commitmeta` files with signatures) and delta indexes are
+rewritten in place, so they are copied whenever their content differs, like refs. Immutable files go first, followed
+by the changed mutable files and refs and finally the summary, so that the mirror never refers to files it doesn't
+have yet. Each file is copied to a temporary name and renamed to be replaced atomically. The summary files are all
+copied to temporary names first and then renamed right after each other, each summary before its signature.
+"""
+import asyncio
+import filecmp
+import os
+import shutil
+from pathlib import Path
+from typing import Iterable, List, Set
+
+from aiofiles.os import wrap
+
+from nufb import fs
+from nufb.logging import get_logger
+
+LOGGER = get_logger(__name__)
+
+#: Directories of immutable files.
+IMMUTABLE_DIRS = ("objects", "deltas", "summaries")
+#: Suffix of detached commit metadata in the objects directory, rewritten when a commit is signed again.
+COMMITMETA_SUFFIX = ".commitmeta"
+#: Directories of files rewritten in place.
+MUTABLE_DIRS = ("delta-indexes",)
+#: Directories of refs.
+REFS_DIR = "refs"
+#: Files of the summary in the order they are replaced.
+SUMMARY_FILES = ("summary.idx", "summary.idx.sig", "summary", "summary.sig")
+
+
+def _list_files(root: Path, subdirs: Iterable[str]) -> Set[str]:
+    files = set()
+    for subdir in subdirs:
+        for directory, _dirs, names in os.walk(root / subdir):
+            for name in names:
+                if not (name.startswith(".") and name.endswith(".tmp")):
+                    files.add(os.path.relpath(os.path.join(directory, name), root))
+    return files
+
+
+def _copy_file(source: Path, destination: Path) -> None:
+    _copy_files_together(source.parent, destination.parent, [source.name])
+
+
+def _copy_files_together(source_dir: Path, destination_dir: Path, paths: Iterable[str]) -> None:
+    destination_dir.mkdir(parents=True, exist_ok=True)
+    copied = []
+    for path in paths:
+        destination = destination_dir / path
+        tmp = destination.with_name(f".{destination.name}.tmp")
+        shutil.copyfile(source_dir / path, tmp)
+        copied.append((tmp, destination))
+    for tmp, destination in copied:
+        os.replace(tmp, destination)
+
+
+def _is_changed(source: Path, destination: Path) -> bool:
+    try:
+        return not filecmp.cmp(source, destination, shallow=False)
+    except FileNotFoundError:
+        return True
+
+
+#: List relative paths of files in subdirectories.
+list_files = wrap(_list_files)
+#: Copy a file and replace the destination atomically.
+copy_file = wrap(_copy_file)
+#: Copy files to temporary names first and then replace the destinations in the given order.
+copy_files_together = wrap(_copy_files_together)
+#: Check whether a file is missing in the destination or has different content.
+is_changed = wrap(_is_changed)
+
+
+async def copy_files(source_dir: Path, destination_dir: Path, paths: Iterable[str], jobs: int) -> None:
+    """
+    Copy files with a bounded pool.
+
+    :param source_dir: The source directory.
+    :param destination_dir: The destination directory.
+    :param paths: Relative paths of files to copy.
+    :param jobs: The number of concurrent copies.
+    :raise OSError: When a filesystem operation fails.
+    """
+    semaphore = asyncio.BoundedSemaphore(jobs)
+
+    async def task(path: str) -> None:
+        async with semaphore:
+            await copy_file(source_dir / path, destination_dir / path)
+
+    await asyncio.gather(*map(task, paths))
+
+
+async def filter_changed(source_dir: Path, destination_dir: Path, paths: Iterable[str], jobs: int) -> List[str]:
+    """
+    Filter files which are missing in the destination or have different content with a bounded pool.
+
+    :param source_dir: The source directory.
+    :param destination_dir: The destination directory.
+    :param paths: Relative paths of files to check.
+    :param jobs: The number of concurrent comparisons.
+    :return: Sorted relative paths of changed files.
+    :raise OSError: When a filesystem operation fails.
+    """
+    semaphore = asyncio.BoundedSemaphore(jobs)
+
+    async def task(path: str) -> bool:
+        async with semaphore:
+            return await is_changed(source_dir / path, destination_dir / path)
+
+    paths = sorted(paths)
+    changed = await asyncio.gather(*map(task, paths))
+    return [path for path, is_path_changed in zip(paths, changed) if is_path_changed]
+
+
+async def publish_repo(repo_dir: Path, destination_dir: Path, jobs: int = 8) -> None:
+    """
+    Copy new files of the repository to a mirror directory.
+
+    Files removed from the repository, e.g. by pruning, are kept in the mirror.
+
+    :param repo_dir: The repository.
+    :param destination_dir: The mirror directory, a local path or a mount.
+    :param jobs: The number of concurrent copies.
+    :raise OSError: When a filesystem operation fails.
+    """
+    if await is_changed(repo_dir / "config", destination_dir / "config"):
+        await copy_file(repo_dir / "config", destination_dir / "config")
+
+    files = await list_files(repo_dir, IMMUTABLE_DIRS)
+    commitmeta = {path for path in files if path.endswith(COMMITMETA_SUFFIX)}
+    new_files = files - commitmeta - await list_files(destination_dir, IMMUTABLE_DIRS)
+    LOGGER.info("Publishing %d new objects and deltas to %s.", len(new_files), destination_dir)
+    await copy_files(repo_dir, destination_dir, sorted(new_files), jobs)
+
+    mutable = await filter_changed(
+        repo_dir, destination_dir, commitmeta | await list_files(repo_dir, MUTABLE_DIRS), jobs
+    )
+    LOGGER.info("Publishing %d changed signatures and delta indexes to %s.", len(mutable), destination_dir)
+    await copy_files(repo_dir, destination_dir, mutable, jobs)
+
+    refs = await filter_changed(repo_dir, destination_dir, await list_files(repo_dir, [REFS_DIR]), jobs)
+    LOGGER.info("Publishing %d changed refs to %s.", len(refs), destination_dir)
+    await copy_files(repo_dir, destination_dir, refs, jobs)
+
+    summary_files = [name for name in SUMMARY_FILES if await fs.isfile(repo_dir / name)]
+    await copy_files_together(repo_dir, destination_dir, summary_files)
+    LOGGER.info("Published %s to %s.", repo_dir, destination_dir)
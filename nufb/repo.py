@@ -1,15 +1,300 @@
+import asyncio
+import json
+import os
+from contextlib import suppress
 from os import fspath
 from os.path import expanduser, expandvars
 from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+
+from aiofiles.os import wrap
 
 from nufb import fs
 from nufb.logging import get_logger
-from nufb.utils import exec_subprocess
+from nufb.tracing import span
+from nufb.utils import exec_subprocess, get_user_cache_dir
 
 LOGGER = get_logger(__name__)
 
+#: Refs and settings of repositories at their last update, in the cache directory.
+REPO_STATE_FILE = "repo-state.json"
+
+
+async def get_exported_commit(repo_dir: Path, flatpak_id: str, branch: str) -> Optional[str]:
+    """
+    Get the commit a flatpak ref points to in the repository.
+
+    :param repo_dir: The repository.
+    :param flatpak_id: The id of the flatpak, an app or a runtime.
+    :param branch: The branch of the flatpak.
+    :return: The commit hash or `None` if there is no such ref.
+    """
+    for ref in sorted(repo_dir.glob(f"refs/heads/*/{flatpak_id}/*/{branch}")):
+        async with fs.open(ref) as fh:
+            return (await fh.read()).strip()
+    return None
+
+
+async def get_ref_commit(repo_dir: Path, ref: str) -> Optional[str]:
+    """
+    Get the commit a ref points to.
+
+    :param repo_dir: The repository.
+    :param ref: The ref, e.g. `app/<id>/<arch>/<branch>`.
+    :return: The commit hash or `None` if there is no such ref.
+    """
+    try:
+        async with fs.open(repo_dir / "refs" / "heads" / ref) as fh:
+            return (await fh.read()).strip()
+    except FileNotFoundError:
+        return None
+
+
+#: The size of a SHA256 checksum in bytes.
+CHECKSUM_SIZE = 32
+
+
+def parse_commit_tree(data: bytes) -> Tuple[bytes, bytes]:
+    """
+    Parse checksums of the root directory contents and metadata from a commit object.
+
+    A commit object is a serialized GVariant `(a{sv}aya(say)sstayay)`. Framing offsets of its six variable-size
+    members except the last one are stored in reverse order at the end. Their size depends on the size of the object.
+    The 8-aligned timestamp follows the body and precedes the root contents and root metadata checksums.
+
+    :param data: The commit object.
+    :return: The checksums of the root directory contents and metadata.
+    :raise ValueError: If the commit object is truncated or corrupted.
+    """
+    size = len(data)
+    offset_size = 1 if size <= 0xFF else 2 if size <= 0xFFFF else 4 if size <= 0xFFFFFFFF else 8
+    end = size - 6 * offset_size
+    if end < 0:
+        raise ValueError(f"Commit object is too short: {size} bytes.")
+
+    offsets = [int.from_bytes(data[size - (i + 1) * offset_size : size - i * offset_size], "little") for i in range(6)]
+    timestamp = (offsets[4] + 7) & ~7
+    bounds = [*offsets[:5], timestamp + 8, offsets[5], end]
+    if any(start > stop for start, stop in zip(bounds, bounds[1:])):
+        raise ValueError(f"Invalid framing offsets of a commit object: {offsets}.")
+
+    contents, metadata = data[timestamp + 8 : offsets[5]], data[offsets[5] : end]
+    if len(contents) != CHECKSUM_SIZE or len(metadata) != CHECKSUM_SIZE:
+        raise ValueError(f"Invalid root checksums of a commit object: {contents.hex()}, {metadata.hex()}.")
+    return contents, metadata
+
+
+def _read_commit_tree(repo_dir: Path, commit: str) -> Tuple[bytes, bytes]:
+    return parse_commit_tree((repo_dir / "objects" / commit[:2] / f"{commit[2:]}.commit").read_bytes())
+
+
+#: Read checksums of the root directory contents and metadata of a commit.
+read_commit_tree = wrap(_read_commit_tree)
+
+
+async def is_tree_unchanged(src_repo: Path, dst_repo: Path, ref: str) -> bool:
+    """
+    Check whether a ref in the source repository has the same file tree as in the destination repository.
+
+    :param src_repo: The source repository.
+    :param dst_repo: The destination repository.
+    :param ref: The ref, e.g. `app/<id>/<arch>/<branch>`.
+    :return: `True` if both commits have the same root tree, `False` otherwise or if the ref is missing or its commit
+        cannot be read.
+    """
+    src_commit = await get_ref_commit(src_repo, ref)
+    dst_commit = await get_ref_commit(dst_repo, ref)
+    if not src_commit or not dst_commit:
+        return False
+    try:
+        return await read_commit_tree(src_repo, src_commit) == await read_commit_tree(dst_repo, dst_commit)
+    except (OSError, ValueError) as e:
+        LOGGER.warning("Cannot compare trees of %s.", ref, exc_info=e)
+        return False
+
+
+async def are_trees_unchanged(src_repo: Path, dst_repo: Path, refs: List[str]) -> bool:
+    """
+    Check whether all refs in the source repository have the same file trees as in the destination repository.
+
+    :param src_repo: The source repository.
+    :param dst_repo: The destination repository.
+    :param refs: The refs, e.g. `app/<id>/<arch>/<branch>`.
+    :return: `True` if there are some refs and all of them are unchanged, `False` otherwise.
+    """
+    for ref in refs:
+        if not await is_tree_unchanged(src_repo, dst_repo, ref):
+            return False
+    return bool(refs)
+
+
+async def get_repo_refs(repo_dir: Path) -> List[str]:
+    """
+    Get flatpak refs in a repository.
+
+    :param repo_dir: The repository.
+    :return: Sorted refs, e.g. `app/<id>/<arch>/<branch>`.
+    """
+    return sorted(str(ref.relative_to(repo_dir / "refs" / "heads")) for ref in repo_dir.glob("refs/heads/*/*/*/*"))
+
+
+async def sign_ref(repo_dir: Path, key_id: str, ref: str) -> None:
+    """
+    Sign the commit a ref points to.
+
+    :param repo_dir: The repository.
+    :param key_id: The GPG key to sign the commit with.
+    :param ref: The ref, e.g. `app/<id>/<arch>/<branch>`.
+    :raise ValueError: On failure.
+    """
+    kind, flatpak_id, arch, branch = ref.split("/")
+    argv = ["flatpak", "build-sign", f"--gpg-sign={key_id}", f"--arch={arch}"]
+    if kind == "runtime":
+        argv.append("--runtime")
+    argv.extend([fspath(repo_dir), flatpak_id, branch])
+    LOGGER.debug("Running %s in %s.", argv, repo_dir)
+    code, out = await exec_subprocess(argv, cwd=repo_dir)
+    if code:
+        LOGGER.error("%s returned %d.\n%s", argv, code, out)
+        raise ValueError(code)
+
+
+async def sign_refs(repo_dir: Path, key_id: str, refs: List[str], jobs: int = 4) -> None:
+    """
+    Sign the commits the refs point to with a bounded pool.
+
+    `flatpak build-sign` signs a single ref per invocation, so the invocations run concurrently instead.
 
-async def update_repo(config: dict) -> None:
+    :param repo_dir: The repository.
+    :param key_id: The GPG key to sign the commits with.
+    :param refs: The refs, e.g. `app/<id>/<arch>/<branch>`.
+    :param jobs: The number of concurrent invocations.
+    :raise ValueError: On failure.
+    """
+    semaphore = asyncio.BoundedSemaphore(jobs)
+
+    async def task(ref: str) -> None:
+        async with semaphore:
+            await sign_ref(repo_dir, key_id, ref)
+
+    await asyncio.gather(*map(task, refs))
+    LOGGER.info("Signed %d refs.", len(refs))
+
+
+async def update_summary(repo_dir: Path, key_id: str) -> None:
+    """
+    Update the summary of the repository without regenerating appstream data.
+
+    :param repo_dir: The repository.
+    :param key_id: The GPG key to sign the summary with.
+    :raise ValueError: On failure.
+    """
+    argv = ["flatpak", "build-update-repo", "--no-update-appstream", f"--gpg-sign={key_id}", fspath(repo_dir)]
+    LOGGER.debug("Running %s in %s.", argv, repo_dir)
+    code, out = await exec_subprocess(argv, cwd=repo_dir)
+    if code:
+        LOGGER.error("%s returned %d.\n%s", argv, code, out)
+        raise ValueError(code)
+    else:
+        LOGGER.info("%s returned %d.", argv, code)
+
+
+async def get_repo_commits(repo_dir: Path) -> Dict[str, Optional[str]]:
+    """
+    Get commits of all flatpak refs in a repository.
+
+    :param repo_dir: The repository.
+    :return: Mapping of refs to commits.
+    """
+    return {ref: await get_ref_commit(repo_dir, ref) for ref in await get_repo_refs(repo_dir)}
+
+
+def get_static_delta_args(repository: dict) -> List[str]:
+    """
+    Get arguments of `flatpak build-update-repo` to generate static deltas.
+
+    flatpak generates deltas of the current commits of refs from their parents and from empty in parallel jobs,
+    skips deltas which already exist and deletes deltas which are no longer wanted, e.g. from pruned commits. Debug
+    extensions are skipped, as they are rarely installed.
+
+    :param repository: The repository section of configuration.
+    :return: The arguments or an empty list if static deltas are disabled.
+    """
+    if not repository.get("static_deltas"):
+        return []
+    jobs = repository.get("static_delta_jobs") or os.cpu_count() or 1
+    return ["--generate-static-deltas", f"--static-delta-jobs={jobs}", "--static-delta-ignore-ref=*.Debug"]
+
+
+def _has_summary_and_appstream(repo_dir: Path) -> bool:
+    return (repo_dir / "summary").is_file() and any(repo_dir.glob("refs/heads/appstream*/*"))
+
+
+#: Check whether the repository has its summary and appstream refs.
+has_summary_and_appstream = wrap(_has_summary_and_appstream)
+
+
+async def get_summary_stat(repo_dir: Path) -> Optional[List[int]]:
+    """
+    Get the size and modification time of the summary of the repository.
+
+    :param repo_dir: The repository.
+    :return: The size in bytes and mtime in nanoseconds or `None` if there is no summary.
+    """
+    try:
+        stat = await fs.stat(repo_dir / "summary")
+    except FileNotFoundError:
+        return None
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+async def load_repo_state(state_file: Path, repo_dir: Path) -> Optional[dict]:
+    """
+    Load the state of the repository at its last update.
+
+    :param state_file: The file with states of repositories.
+    :param repo_dir: The repository.
+    :return: The state or `None` if there is none.
+    """
+    try:
+        async with fs.open(state_file) as fh:
+            return json.loads(await fh.read()).get(fspath(repo_dir))
+    except FileNotFoundError:
+        return None
+
+
+async def save_repo_state(state_file: Path, repo_dir: Path, state: dict) -> None:
+    """
+    Save the state of the repository at its last update.
+
+    :param state_file: The file with states of repositories.
+    :param repo_dir: The repository.
+    :param state: The state.
+    """
+    states = {}
+    with suppress(FileNotFoundError):
+        async with fs.open(state_file) as fh:
+            states = json.loads(await fh.read())
+    states[fspath(repo_dir)] = state
+    await fs.makedirs(state_file.parent, exist_ok=True)
+    async with fs.open(state_file, "w") as fh:
+        await fh.write(json.dumps(states, indent=2, sort_keys=True))
+
+
+async def update_repo(config: dict, force: bool = False) -> None:
+    """
+    Update the summary and appstream data of the repository.
+
+    The refs and settings of the last update are recorded in the cache directory, outside of the published
+    repository. The update is skipped if nothing has changed since then and appstream data are regenerated only when
+    an app has changed, because runtimes and debug extensions don't contribute to them. The full update runs whenever
+    the summary or appstream refs are missing or the summary is not the one written by the last update, e.g. when
+    the repository has been restored.
+
+    :param config: Configuration.
+    :param force: Run the full update even if nothing has changed.
+    :raise ValueError: On failure.
+    """
     repository = config["repository"]
     repo_dir = Path(expandvars(expanduser(repository["path"]))).absolute()
     key_id = repository["key_id"]
@@ -18,6 +303,25 @@ async def update_repo(config: dict) -> None:
 
     await fs.makedirs(repo_dir, exist_ok=True)
 
+    state_file = get_user_cache_dir("nuvola-flatpaks") / REPO_STATE_FILE
+    state: Dict[str, Any] = {
+        "settings": {
+            "title": name,
+            "default_branch": branch,
+            "key_id": key_id,
+            "static_deltas": bool(repository.get("static_deltas")),
+        },
+        "refs": await get_repo_commits(repo_dir),
+        "summary": await get_summary_stat(repo_dir),
+    }
+    previous = await load_repo_state(state_file, repo_dir)
+    if not await has_summary_and_appstream(repo_dir):
+        LOGGER.info("The summary or appstream data of %s are missing.", repo_dir)
+        previous = None
+    elif previous and previous.get("summary") != state["summary"]:
+        LOGGER.info("The summary of %s has changed since the last update.", repo_dir)
+        previous = None
+
     argv = [
         "time",
         "flatpak",
@@ -26,17 +330,32 @@ async def update_repo(config: dict) -> None:
         f"--title={name}",
         f"--default-branch={branch}",
         f"--gpg-sign={key_id}",
+        *get_static_delta_args(repository),
         fspath(repo_dir),
     ]
 
+    if previous and not force:
+        if previous == state:
+            LOGGER.info("Update of %s skipped: Nothing has changed since the last update.", repo_dir)
+            return
+        refs, previous_refs = state["refs"], previous["refs"]
+        changed = {ref for ref in refs.keys() | previous_refs.keys() if refs.get(ref) != previous_refs.get(ref)}
+        if previous["settings"] == state["settings"] and not any(ref.startswith("app/") for ref in changed):
+            LOGGER.info("Only runtimes have changed, appstream data of %s are not regenerated.", repo_dir)
+            argv.insert(-1, "--no-update-appstream")
+
     LOGGER.debug("Running %s in %s.", argv, repo_dir)
-    code, out = await exec_subprocess(argv, cwd=repo_dir)
+    async with span("update_repo", "repository", path=fspath(repo_dir)):
+        code, out = await exec_subprocess(argv, cwd=repo_dir)
     if code:
         LOGGER.error("%s returned %d.\n%s", argv, code, out)
         raise ValueError(code)
     else:
         LOGGER.info("%s returned %d.\n%s", argv, code, out)
 
+    state["summary"] = await get_summary_stat(repo_dir)
+    await save_repo_state(state_file, repo_dir, state)
+
 
 async def prune_repo(config: dict, depth: int) -> None:
     repository = config["repository"]
@@ -53,6 +372,7 @@ async def prune_repo(config: dict, depth: int) -> None:
         "--prune",
         f"--prune-depth={depth}",
         f"--gpg-sign={key_id}",
+        *get_static_delta_args(repository),
         fspath(repo_dir),
     ]
 
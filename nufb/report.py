@@ -0,0 +1,62 @@
+# Copyright 2019-2020 Jiří Janoušek <janousek.jiri@gmail.com>
+# License: BSD-2-Clause, see file LICENSE at the project root.
+"""
+Installed-size reports produced by the filelist check of the last module.
+"""
+import json
+from pathlib import Path
+
+from nufb import fs
+from nufb.logging import get_logger
+from nufb.utils import exec_subprocess
+
+LOGGER = get_logger(__name__)
+
+#: The location of the report within the debug extension.
+SIZE_REPORT = "files/filelist/sizes.json"
+
+
+async def load_size_report(manifest_id: str, branch: str) -> dict:
+    """
+    Load the size report from the installed debug extension of a flatpak.
+
+    :param manifest_id: The id of the flatpak.
+    :param branch: The branch of the flatpak.
+    :return: The size report.
+    :raise ValueError: When the debug extension is not installed.
+    :raise OSError: When the report cannot be read.
+    """
+    argv = ["flatpak", "info", "--show-location", f"{manifest_id}.Debug//{branch}"]
+    code, out = await exec_subprocess(argv)
+    if code:
+        LOGGER.error("%s returned %d.\n%s", argv, code, out)
+        raise ValueError(code)
+
+    async with fs.open(Path(out.strip()) / SIZE_REPORT) as fh:
+        return json.loads(await fh.read())
+
+
+def format_size(size: int) -> str:
+    value = float(size)
+    for unit in ("B", "KiB", "MiB"):
+        if value < 1024:
+            return f"{value:.1f} {unit}"
+        value /= 1024
+    return f"{value:.1f} GiB"
+
+
+def format_size_report(report: dict, top: int = 20, rules: bool = False) -> str:
+    """
+    Format the top contributors of a size report.
+
+    :param report: The size report.
+    :param top: The number of contributors to show.
+    :param rules: Show individual `x-keep` rules instead of modules.
+    :return: Formatted report.
+    """
+    total = report["total"]
+    lines = [f"{'Total':<60} {format_size(total['bytes']):>12} {total['files']:>8} files"]
+    for name, item in list(report["rules" if rules else "modules"].items())[:top]:
+        share = 100 * item["bytes"] / total["bytes"] if total["bytes"] else 0
+        lines.append(f"{name:<60} {format_size(item['bytes']):>12} {item['files']:>8} files {share:5.1f}%")
+    return "\n".join(lines)
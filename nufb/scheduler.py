@@ -0,0 +1,202 @@
+# Copyright 2019-2020 Jiří Janoušek <janousek.jiri@gmail.com>
+# License: BSD-2-Clause, see file LICENSE at the project root.
+"""
+Scheduling of dependent builds.
+"""
+import asyncio
+import heapq
+from typing import Any, Awaitable, Callable, Dict, Iterable, List, Optional, Set, Tuple
+
+from nufb import metrics
+from nufb.logging import get_logger
+from nufb.manifest import Manifest
+
+LOGGER = get_logger(__name__)
+
+#: The suffix of the debug extension of a flatpak.
+DEBUG_SUFFIX = ".Debug"
+
+
+class BuildNode:
+    """
+    A single build in a :class:`BuildGraph`.
+    """
+
+    manifest: Manifest
+    run: Callable[..., Awaitable[Any]]
+    weight: float
+    dependencies: Set["BuildNode"]
+    dependents: Set["BuildNode"]
+    priority: float
+
+    def __init__(self, manifest: Manifest, run: Callable[..., Awaitable[Any]], weight: float = 1.0):
+        """
+        :param manifest: The manifest of the build.
+        :param run: The function to run the build.
+        :param weight: The estimated duration of the build.
+        """
+        self.manifest = manifest
+        self.run = run
+        self.weight = weight
+        self.dependencies = set()
+        self.dependents = set()
+        self.priority = weight
+
+    @property
+    def ref(self) -> Tuple[str, str]:
+        return self.manifest.id, self.manifest.branch
+
+    @property
+    def name(self) -> str:
+        return f"{self.manifest.id}//{self.manifest.branch}"
+
+    def __repr__(self) -> str:
+        return f"<BuildNode {self.name}>"
+
+
+class BuildGraph:
+    """
+    A graph of builds linked by the `sdk`, `runtime`, `base` and `base-extensions` fields of their manifests.
+
+    Each build is started as soon as all builds it depends on finish. Ready builds are started in the order of
+    their critical path, i.e. the longest chain of weights of the build and the builds depending on it.
+    """
+
+    nodes: Dict[Tuple[str, str], BuildNode]
+
+    def __init__(self) -> None:
+        self.nodes = {}
+
+    def add(self, node: BuildNode) -> None:
+        """
+        Add a build to the graph.
+
+        :param node: The build.
+        :raise ValueError: If a build of the same flatpak and branch is already present.
+        """
+        if node.ref in self.nodes:
+            raise ValueError(f"Duplicate build: {node.name}")
+        self.nodes[node.ref] = node
+
+    def link(self) -> None:
+        """
+        Link builds to builds providing their dependencies and compute their priorities.
+
+        Dependencies not built within the graph (e.g. the GNOME runtime) are ignored.
+
+        :raise ValueError: If there is a dependency cycle.
+        """
+        for node in self.nodes.values():
+            for flatpak_id, version in node.manifest.required_refs():
+                if flatpak_id.endswith(DEBUG_SUFFIX):
+                    flatpak_id = flatpak_id[: -len(DEBUG_SUFFIX)]
+                provider = self.nodes.get((flatpak_id, version))
+                if provider is not None and provider is not node:
+                    node.dependencies.add(provider)
+                    provider.dependents.add(node)
+
+        priorities: Dict[BuildNode, Optional[float]] = {}
+
+        def compute_priority(node: BuildNode) -> float:
+            if node in priorities:
+                priority = priorities[node]
+                if priority is None:
+                    raise ValueError(f"Dependency cycle: {node.name}")
+                return priority
+
+            priorities[node] = None
+            priority = node.weight + max(map(compute_priority, node.dependents), default=0.0)
+            priorities[node] = node.priority = priority
+            return priority
+
+        for node in self.nodes.values():
+            compute_priority(node)
+
+    async def run(self, concurrency: int = None) -> None:
+        """
+        Run all builds.
+
+        When a build fails, the builds depending on it are not started, the other builds continue and the first
+        error is raised once they finish.
+
+        :param concurrency: The maximal number of builds running at the same time.
+        """
+        self.link()
+        state = _RunState(self.nodes.values())
+        while state.ready or state.running:
+            state.start_ready(concurrency)
+            done, _pending = await asyncio.wait(state.running, return_when=asyncio.FIRST_COMPLETED)
+            for future in done:
+                state.finish(future)
+
+        if state.errors:
+            raise state.errors[0]
+
+
+class _RunState:
+    """
+    The state of :meth:`BuildGraph.run`: builds waiting for their dependencies, ready to start, and running.
+    """
+
+    waiting: Dict[BuildNode, int]
+    ready: List[Tuple[float, int, BuildNode]]
+    running: Dict[asyncio.Future, BuildNode]
+    errors: List[BaseException]
+
+    def __init__(self, nodes: Iterable[BuildNode]):
+        self.waiting = {node: len(node.dependencies) for node in nodes}
+        self.ready = []
+        self.running = {}
+        self.errors = []
+        self._counter = 0
+
+        metrics.inc("nufb_builds", len(self.waiting), state="queued")
+        for node, count in self.waiting.items():
+            if not count:
+                self.push(node)
+
+    def push(self, node: BuildNode) -> None:
+        heapq.heappush(self.ready, (-node.priority, self._counter, node))
+        self._counter += 1
+
+    def skip(self, node: BuildNode) -> None:
+        for dependent in node.dependents:
+            if self.waiting.pop(dependent, None) is not None:
+                LOGGER.error("Build %s skipped because its dependency %s failed.", dependent.name, node.name)
+                metrics.dec("nufb_builds", state="queued")
+                metrics.inc("nufb_builds_done_total", outcome="cancelled")
+                self.skip(dependent)
+
+    def start_ready(self, concurrency: Optional[int]) -> None:
+        """
+        Start ready builds with the longest critical paths while the concurrency allows.
+
+        :param concurrency: The maximal number of builds running at the same time.
+        """
+        while self.ready and (not concurrency or len(self.running) < concurrency):
+            node = heapq.heappop(self.ready)[2]
+            self.waiting.pop(node)
+            metrics.dec("nufb_builds", state="queued")
+            LOGGER.info("Starting build %s (critical path %.1f).", node.name, node.priority)
+            self.running[asyncio.ensure_future(node.run())] = node
+
+    def finish(self, future: asyncio.Future) -> None:
+        """
+        Handle a finished build: skip its dependents if it failed, otherwise mark those ready whose dependencies
+        have all finished.
+
+        :param future: The future of the build.
+        """
+        node = self.running.pop(future)
+        error = future.exception()
+        if error is not None:
+            LOGGER.error("Build %s failed: %s", node.name, error)
+            self.errors.append(error)
+            self.skip(node)
+            return
+
+        for dependent in node.dependents:
+            if dependent in self.waiting:
+                self.waiting[dependent] -= 1
+                if not self.waiting[dependent]:
+                    self.push(dependent)
@@ -0,0 +1,131 @@
+# Copyright 2019-2020 Jiří Janoušek <janousek.jiri@gmail.com>
+# License: BSD-2-Clause, see file LICENSE at the project root.
+"""
+A pool of CPU and memory budgets shared by concurrent builds.
+"""
+import asyncio
+import os
+import re
+from collections import deque
+from contextlib import asynccontextmanager
+from fnmatch import fnmatchcase
+from typing import AsyncIterator, Deque, Dict, Optional, Tuple, Union
+
+from nufb.logging import get_logger
+
+LOGGER = get_logger(__name__)
+SIZE_RE = re.compile(r"^\s*(\d+(?:\.\d+)?)\s*([KMGT]?)i?B?\s*$", re.IGNORECASE)
+SIZE_UNITS = {"": 1, "K": 1 << 10, "M": 1 << 20, "G": 1 << 30, "T": 1 << 40}
+
+
+def parse_size(size: Union[int, str]) -> int:
+    """
+    Parse a size such as `512M` or `16G` to bytes.
+
+    :param size: The size in bytes or a string with an optional binary unit suffix.
+    :return: The size in bytes.
+    :raise ValueError: If the size is not valid.
+    """
+    if isinstance(size, int):
+        return size
+    m = SIZE_RE.match(size)
+    if not m:
+        raise ValueError(f"Invalid size: {size!r}")
+    return int(float(m.group(1)) * SIZE_UNITS[m.group(2).upper()])
+
+
+def get_total_memory() -> int:
+    return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+
+
+class BuildSlots:
+    """
+    Admit builds while their CPU and memory budgets fit into the capacity of the machine.
+
+    Builds are admitted in the order they asked for a slot, so a large build such as the CDK is not starved by
+    a stream of small ones.
+
+    The `build_slots` section of `nufb.yml` sets the capacity (`cpus`, `memory`, defaulting to the whole machine)
+    and budgets of builds in `manifests`, a mapping of manifest id patterns to `cpus` and `memory`. The first
+    matching pattern is used. Builds without a budget take all CPUs and no memory, i.e. they run alone as if
+    serialized by a lock.
+    """
+
+    cpus: int
+    memory: int
+    budgets: Dict[str, Tuple[int, int]]
+
+    def __init__(self, cpus: int = None, memory: int = None, budgets: Dict[str, Tuple[int, int]] = None):
+        """
+        :param cpus: The number of CPUs available to builds.
+        :param memory: The memory available to builds in bytes.
+        :param budgets: CPUs and memory requested by builds of manifest id patterns.
+        """
+        self.cpus = cpus or os.cpu_count() or 1
+        self.memory = memory or get_total_memory()
+        self.budgets = budgets or {}
+        self.free_cpus = self.cpus
+        self.free_memory = self.memory
+        self._queue: Deque[object] = deque()
+        self._changed = asyncio.Condition()
+
+    @classmethod
+    def from_config(cls, config: Optional[dict]) -> "BuildSlots":
+        """
+        Create build slots from the `build_slots` section of configuration.
+
+        :param config: Configuration.
+        :return: New build slots.
+        """
+        slots = (config or {}).get("build_slots") or {}
+        memory = slots.get("memory")
+        budgets = {
+            pattern: (int(budget.get("cpus", 0)), parse_size(budget.get("memory", 0)))
+            for pattern, budget in (slots.get("manifests") or {}).items()
+        }
+        return cls(slots.get("cpus"), parse_size(memory) if memory else None, budgets)
+
+    def get_budget(self, manifest_id: str) -> Tuple[int, int]:
+        """
+        Get the CPUs and memory requested by a build.
+
+        :param manifest_id: The id of the manifest.
+        :return: The number of CPUs and bytes of memory, capped to the capacity.
+        """
+        cpus, memory = self.cpus, 0
+        for pattern, budget in self.budgets.items():
+            if fnmatchcase(manifest_id, pattern):
+                cpus, memory = budget
+                break
+        return max(1, min(cpus or self.cpus, self.cpus)), min(memory, self.memory)
+
+    @asynccontextmanager
+    async def acquire(self, manifest_id: str) -> AsyncIterator[int]:
+        """
+        Wait for a slot for a build.
+
+        :param manifest_id: The id of the manifest.
+        :return: The number of parallel jobs the build should use.
+        """
+        cpus, memory = self.get_budget(manifest_id)
+        token = object()
+        async with self._changed:
+            self._queue.append(token)
+            try:
+                await self._changed.wait_for(
+                    lambda: self._queue[0] is token and cpus <= self.free_cpus and memory <= self.free_memory
+                )
+            finally:
+                self._queue.remove(token)
+                self._changed.notify_all()
+            self.free_cpus -= cpus
+            self.free_memory -= memory
+
+        LOGGER.debug("Build slot for %s acquired: %d CPUs, %d bytes of memory.", manifest_id, cpus, memory)
+        try:
+            yield cpus
+        finally:
+            async with self._changed:
+                self.free_cpus += cpus
+                self.free_memory += memory
+                self._changed.notify_all()
@@ -0,0 +1,78 @@
+# Copyright 2019-2020 Jiří Janoušek <janousek.jiri@gmail.com>
+# License: BSD-2-Clause, see file LICENSE at the project root.
+"""
+YAML documents parsed once per run and rendered with substitutions.
+
+A document is parsed with its `@NAME@` placeholders intact and kept until its file changes. Rendering substitutes
+the placeholders in string keys and values of a fresh copy of the parsed tree, so all apps built from the
+`eu.tiliado.NuvolaApp.yml` template share a single YAML parse.
+"""
+from pathlib import Path
+from typing import Any, Dict, Optional, Tuple
+
+from nufb import fs, utils
+
+
+class Template:
+    data: dict
+
+    def __init__(self, data: dict):
+        """
+        :param data: The parsed document with placeholders.
+        """
+        self.data = data
+
+    def render(self, subst: Dict[str, Any] = None) -> dict:
+        """
+        Render the document.
+
+        :param subst: Substitutions of placeholders or `None` to keep them.
+        :return: A copy of the document which can be modified freely.
+        :raise KeyError: When a substitution of a placeholder is missing.
+        """
+        return _render(self.data, subst)
+
+
+def _render(node: Any, subst: Optional[Dict[str, Any]]) -> Any:
+    if isinstance(node, dict):
+        return {_render(key, subst): _render(value, subst) for key, value in node.items()}
+    if isinstance(node, list):
+        return [_render(item, subst) for item in node]
+    if subst is not None and isinstance(node, str) and "@" in node:
+        return utils.SUBST_RE.sub(lambda m: str(subst[m.group(1)]), node)
+    return node
+
+
+_TEMPLATES: Dict[Path, Tuple[Tuple[int, int], Template]] = {}
+
+
+async def load_template(path: Path) -> Template:
+    """
+    Load a YAML document as a template, reusing the parsed one while the file size and mtime don't change.
+
+    :param path: The YAML file.
+    :return: The template.
+    :raise OSError: When the file cannot be read.
+    """
+    stat = await fs.stat(path)
+    key = stat.st_mtime_ns, stat.st_size
+    cached = _TEMPLATES.get(path)
+    if cached is not None and cached[0] == key:
+        return cached[1]
+
+    template = Template(await utils.load_yaml(path))
+    _TEMPLATES[path] = key, template
+    return template
+
+
+async def load_document(path: Path, subst: Dict[str, Any] = None) -> dict:
+    """
+    Load a YAML document and substitute its placeholders.
+
+    :param path: The YAML file.
+    :param subst: Substitutions of placeholders or `None` to keep them.
+    :return: Python representation of the YAML document which can be modified freely.
+    :raise OSError: When the file cannot be read.
+    :raise KeyError: When a substitution of a placeholder is missing.
+    """
+    return (await load_template(path)).render(subst)
@@ -0,0 +1,137 @@
+# Copyright 2019-2020 Jiří Janoušek <janousek.jiri@gmail.com>
+# License: BSD-2-Clause, see file LICENSE at the project root.
+"""
+Tracing of build phases in the Chrome trace event format.
+
+Tracing is disabled by default and spans are no-ops until :func:`enable_tracing` is called. Each span is recorded
+as a complete event on the track (thread) of its build, with the time spent waiting on locks in its arguments.
+"""
+import json
+import os
+import time
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from pathlib import Path
+from typing import Any, AsyncContextManager, AsyncIterator, Dict, List, Optional, TypeVar
+
+from nufb import fs, metrics
+
+T = TypeVar("T")
+
+
+class Tracer:
+    events: List[dict]
+    tracks: Dict[str, int]
+
+    def __init__(self) -> None:
+        self.origin = time.perf_counter()
+        self.events = []
+        self.tracks = {}
+
+    def add(self, name: str, track: str, start: float, end: float, args: Dict[str, Any]) -> None:
+        """
+        Add a complete event.
+
+        :param name: The name of the event.
+        :param track: The name of the track, e.g. a build.
+        :param start: The start time from :func:`time.perf_counter`.
+        :param end: The end time from :func:`time.perf_counter`.
+        :param args: Arguments of the event.
+        """
+        try:
+            tid = self.tracks[track]
+        except KeyError:
+            tid = self.tracks[track] = len(self.tracks) + 1
+            metadata = {"name": "thread_name", "ph": "M", "pid": os.getpid(), "tid": tid, "args": {"name": track}}
+            self.events.append(metadata)
+
+        self.events.append(
+            {
+                "name": name,
+                "cat": "nufb",
+                "ph": "X",
+                "ts": round((start - self.origin) * 1e6),
+                "dur": round((end - start) * 1e6),
+                "pid": os.getpid(),
+                "tid": tid,
+                "args": args,
+            }
+        )
+
+
+TRACER: Optional[Tracer] = None
+_current_args: ContextVar[Optional[Dict[str, Any]]] = ContextVar("current_args", default=None)
+
+
+def enable_tracing() -> None:
+    """Start recording spans."""
+    global TRACER
+    TRACER = Tracer()
+
+
+async def save_trace(path: Path) -> None:
+    """
+    Save recorded spans to a file.
+
+    :param path: The file to write the trace to.
+    :raise OSError: When a filesystem operation fails.
+    """
+    assert TRACER is not None
+    async with fs.open(path, "w") as fh:
+        await fh.write(json.dumps({"traceEvents": TRACER.events, "displayTimeUnit": "ms"}))
+
+
+@asynccontextmanager
+async def span(name: str, track: str, **args: Any) -> AsyncIterator[None]:
+    """
+    Record a span.
+
+    :param name: The name of the span, e.g. a build phase.
+    :param track: The name of the track, e.g. the build.
+    :param args: Extra arguments of the span.
+    """
+    if TRACER is None:
+        yield
+        return
+
+    token = _current_args.set(args)
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        _current_args.reset(token)
+        TRACER.add(name, track, start, time.perf_counter(), args)
+
+
+@asynccontextmanager
+async def wait_for(lock: AsyncContextManager[T], name: str, track: str) -> AsyncIterator[T]:
+    """
+    Enter a lock and record the time spent waiting for it.
+
+    The waiting is recorded as a separate span and added to the `wait_<name>` argument of the enclosing span.
+    It is also exported as the `nufb_lock_waiting` and `nufb_lock_wait_seconds_total` metrics.
+
+    :param lock: The lock or another asynchronous context manager.
+    :param name: The name of the lock.
+    :param track: The name of the track, e.g. the build.
+    :return: The value of the lock context manager.
+    """
+    start = time.perf_counter()
+    waiting = True
+    metrics.inc("nufb_lock_waiting", lock=name)
+    try:
+        async with lock as value:
+            acquired = time.perf_counter()
+            waiting = False
+            metrics.dec("nufb_lock_waiting", lock=name)
+            metrics.inc("nufb_lock_wait_seconds_total", acquired - start, lock=name)
+            if TRACER is not None:
+                TRACER.add(f"wait {name}", track, start, acquired, {})
+                args = _current_args.get()
+                if args is not None:
+                    key = f"wait_{name}"
+                    args[key] = args.get(key, 0.0) + acquired - start
+            yield value
+    finally:
+        if waiting:
+            metrics.dec("nufb_lock_waiting", lock=name)
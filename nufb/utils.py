@@ -4,31 +4,55 @@
 This module contains various utility functions.
 """
 import asyncio
+import codecs
+import hashlib
+import json
 import os
+import pickle
 import re
 from asyncio.subprocess import DEVNULL, PIPE, STDOUT
+from collections import deque
+from contextlib import suppress
 from io import StringIO
 from pathlib import Path
-from typing import Any, Dict, Optional, Tuple, Union, cast
+from typing import Any, Callable, Deque, Dict, List, Optional, Tuple, Union, cast
 
 import ruamel.yaml
+from aiofiles.os import wrap
 
-from nufb import fs
+from nufb import fs, metrics
 from nufb.logging import get_logger
 
 LOGGER = get_logger(__name__)
 YAML_LOADER = ruamel.yaml.YAML(typ="safe")
+#: Whether the libyaml-based parser of ruamel.yaml.clib is used. It is used if it is installed.
+YAML_LIBYAML = YAML_LOADER.Parser is not ruamel.yaml.parser.Parser
+#: Version of the format of cached YAML documents. Increase it to invalidate the cache.
+YAML_CACHE_VERSION = 1
 SUBST_RE = re.compile(r"@(\w+)@")
+#: The maximal length of a line of streamed output, longer lines are split.
+STREAM_LIMIT = 1024 * 1024
+#: The size of chunks of streamed output.
+STREAM_CHUNK = 64 * 1024
 
 
 async def load_yaml(source: Union[str, Path], subst: Dict[str, Any] = None) -> dict:
     """
-    Load YAML source file/string as Python dictionary.
+    Load YAML source file as Python dictionary.
+
+    Parsed documents are cached in a binary form in the user's cache directory. The cache entry of a file and
+    substitutions is used only while the size, mtime and inode of the file don't change.
 
     :param subst: Substitutions.
-    :param source: The source file or string.
+    :param source: The source file.
     :return: Python representation of the YAML document.
     """
+    stat = await fs.stat(source)
+    cache_file, key = get_yaml_cache_entry(Path(source), subst, stat)
+    dictionary = await load_cached_yaml(cache_file, key)
+    if dictionary is not None:
+        return dictionary
+
     async with fs.open(source) as fh:
         data = await fh.read()
 
@@ -37,9 +61,53 @@ async def load_yaml(source: Union[str, Path], subst: Dict[str, Any] = None) -> d
 
     dictionary = YAML_LOADER.load(StringIO(data))
     assert isinstance(dictionary, dict)
+    await save_cached_yaml(cache_file, key, dictionary)
     return dictionary
 
 
+def get_yaml_cache_entry(path: Path, subst: Optional[Dict[str, Any]], stat: os.stat_result) -> Tuple[Path, tuple]:
+    """
+    Get the cache entry of a parsed YAML document.
+
+    :param path: The YAML file.
+    :param subst: Substitutions.
+    :param stat: The status of the YAML file.
+    :return: The cache file and the key validating its content.
+    """
+    name = hashlib.sha256(json.dumps([str(path.absolute()), subst], sort_keys=True, default=str).encode()).hexdigest()
+    cache_file = get_user_cache_dir("nuvola-flatpaks") / "yaml" / (name + ".pickle")
+    return cache_file, (YAML_CACHE_VERSION, stat.st_size, stat.st_mtime_ns, stat.st_ino)
+
+
+def _load_cached_yaml(cache_file: Path, key: tuple) -> Optional[dict]:
+    try:
+        with cache_file.open("rb") as fh:
+            cached_key, dictionary = pickle.load(fh)
+    except FileNotFoundError:
+        return None
+    except (OSError, EOFError, ValueError, pickle.UnpicklingError) as e:
+        LOGGER.warning("Failed to load cached YAML document %s.", cache_file, exc_info=e)
+        return None
+    return dictionary if cached_key == key else None
+
+
+def _save_cached_yaml(cache_file: Path, key: tuple, dictionary: dict) -> None:
+    try:
+        cache_file.parent.mkdir(parents=True, exist_ok=True)
+        tmp = cache_file.with_name(f"{cache_file.name}.{os.getpid()}.tmp")
+        with tmp.open("wb") as fh:
+            pickle.dump((key, dictionary), fh, pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, cache_file)
+    except OSError as e:
+        LOGGER.warning("Failed to cache YAML document %s.", cache_file, exc_info=e)
+
+
+#: Load a cached YAML document or return `None` if it is missing or outdated.
+load_cached_yaml = wrap(_load_cached_yaml)
+#: Cache a parsed YAML document. Failures are only logged.
+save_cached_yaml = wrap(_save_cached_yaml)
+
+
 def get_user_cache_dir(subdir: Optional[str] = None) -> Path:
     """
     Get user's cache directory or its subdirectory.
@@ -84,7 +152,132 @@ def get_data_path(path: Optional[str] = None) -> Path:
 
 async def exec_subprocess(argv, *, stdin=DEVNULL, stdout=PIPE, stderr=STDOUT, **kwargs) -> Tuple[int, str]:
     proc = await asyncio.create_subprocess_exec(*argv, stdin=stdin, stdout=stdout, stderr=stderr, **kwargs)
-    stdout, stderr = await proc.communicate()
-    assert not stderr
-    result = await proc.wait()
+    metrics.inc("nufb_subprocesses_total")
+    metrics.inc("nufb_subprocesses_running")
+    try:
+        stdout, stderr = await proc.communicate()
+        assert not stderr
+        result = await proc.wait()
+    finally:
+        metrics.dec("nufb_subprocesses_running")
     return result, stdout.decode("utf-8")
+
+
+class LineSplitter:
+    """
+    Split text arriving in chunks into lines of limited length.
+    """
+
+    def __init__(self, limit: int):
+        """
+        :param limit: The maximal length of a line, longer lines are split.
+        """
+        self.limit = limit
+        #: The incremental UTF-8 decoder of the chunks.
+        self.decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+        self._partial = ""
+
+    def feed(self, text: str, final: bool = False) -> List[str]:
+        """
+        Add a chunk of text.
+
+        :param text: The chunk of text.
+        :param final: Whether this is the last chunk, so that an unterminated last line is returned as well.
+        :return: The lines completed by the chunk, without newlines.
+        """
+        *lines, self._partial = (self._partial + text).split("\n")
+        while len(self._partial) >= self.limit:
+            lines.append(self._partial[: self.limit])
+            self._partial = self._partial[self.limit :]
+        if final and self._partial:
+            lines.append(self._partial)
+            self._partial = ""
+        return lines
+
+
+async def copy_output(stream: asyncio.StreamReader, fh: fs.AsyncTextIO, on_line: Callable[[str], None]) -> None:
+    """
+    Copy output of a subprocess to a file as it arrives and pass it on line by line.
+
+    :param stream: The output of the subprocess.
+    :param fh: The file to append the output to. It is flushed after each chunk.
+    :param on_line: A function called with each line of the output, see :class:`LineSplitter`.
+    """
+    splitter = LineSplitter(STREAM_LIMIT)
+    newline = True
+    while True:
+        chunk = await stream.read(STREAM_CHUNK)
+        text = splitter.decoder.decode(chunk, final=not chunk)
+        if text:
+            newline = text.endswith("\n")
+            await fh.write(text)
+            await fh.flush()
+        for line in splitter.feed(text, final=not chunk):
+            on_line(line)
+        if not chunk:
+            break
+    if not newline:
+        await fh.write("\n")
+
+
+async def stream_subprocess(
+    argv, log_file: Path, *, prefix: str, tail: int = 200, on_line: Callable[[str], None] = None, **kwargs
+) -> Tuple[int, str]:
+    """
+    Execute a subprocess and stream its output line by line.
+
+    The output is appended to the log file as it arrives and logged with a prefix line by line. The output is read
+    in chunks, lines longer than :data:`STREAM_LIMIT` are split, and only the last lines are kept in memory, so
+    memory use doesn't grow with the amount of output. The subprocess is killed if streaming fails or is cancelled.
+
+    :param argv: The command and its arguments.
+    :param log_file: The file to append the output to.
+    :param prefix: The prefix of logged lines, e.g. the name of the build.
+    :param tail: The number of last lines to return.
+    :param on_line: A function called with each line of the output as it arrives.
+    :return: The exit code and the last lines of the output.
+    """
+    await fs.makedirs(log_file.parent, exist_ok=True)
+    last_lines: Deque[str] = deque(maxlen=tail)
+
+    def process_line(line: str) -> None:
+        LOGGER.info("%s: %s", prefix, line)
+        if on_line:
+            on_line(line)
+        last_lines.append(line)
+
+    proc = await asyncio.create_subprocess_exec(*argv, stdin=DEVNULL, stdout=PIPE, stderr=STDOUT, **kwargs)
+    assert proc.stdout
+    metrics.inc("nufb_subprocesses_total")
+    metrics.inc("nufb_subprocesses_running")
+    try:
+        async with fs.open(log_file, "a") as fh:
+            await fh.write(f"$ {' '.join(map(str, argv))}\n")
+            await fh.flush()
+            await copy_output(proc.stdout, fh, process_line)
+        code = await proc.wait()
+    finally:
+        # The output was not read to the end, e.g. on cancellation.
+        if proc.returncode is None:
+            with suppress(ProcessLookupError):
+                proc.kill()
+            await proc.wait()
+        metrics.dec("nufb_subprocesses_running")
+
+    return code, "\n".join(last_lines)
+
+
+def _get_tree_size(path: Path) -> int:
+    size = 0
+    inodes = set()
+    for root, _dirs, files in os.walk(path):
+        for name in files:
+            stat = os.lstat(os.path.join(root, name))
+            if stat.st_ino not in inodes:
+                inodes.add(stat.st_ino)
+                size += stat.st_size
+    return size
+
+
+#: Get the size of files in a directory tree in bytes, counting hard links once.
+get_tree_size = wrap(_get_tree_size)
@@ -0,0 +1,29 @@
+# Copyright 2019-2020 Jiří Janoušek <janousek.jiri@gmail.com>
+# License: BSD-2-Clause, see file LICENSE at the project root.
+"""
+Tests of profiling modules from the output of flatpak-builder.
+"""
+from itertools import count
+
+from nufb.buildlog import CACHE_HIT, CACHE_MISS, ModuleProfiler
+
+OUTPUT = """\
+Cache hit for init, skipping
+Cache hit for build-glib, skipping
+Building module gtk in /build/gtk-1
+========================================================================
+Committing stage build-gtk to cache
+Building module nuvola in /build/nuvola-1
+Cache hit for cleanup, skipping
+"""
+
+
+def test_modules_are_keyed_by_module_name():
+    profiler = ModuleProfiler(clock=count().__next__)
+    for line in OUTPUT.splitlines():
+        profiler.feed(line)
+    profiler.finish()
+
+    modules = {name: (stats.cache, stats.finished) for name, stats in profiler.modules.items()}
+    assert modules == {"glib": (CACHE_HIT, True), "gtk": (CACHE_MISS, True), "nuvola": (CACHE_MISS, False)}
+    assert profiler.modules["gtk"].duration == 1
@@ -0,0 +1,45 @@
+# Copyright 2019-2020 Jiří Janoušek <janousek.jiri@gmail.com>
+# License: BSD-2-Clause, see file LICENSE at the project root.
+"""
+Tests of manifests.
+"""
+import asyncio
+from pathlib import Path
+
+from nufb import fingerprint
+from nufb.fingerprint import compute_fingerprint
+from nufb.manifest import Manifest
+
+URL = "https://github.com/tiliado/nuvola-app-deezer.git"
+
+
+def create_manifest() -> Manifest:
+    data = {
+        "app-id": "eu.tiliado.NuvolaAppDeezer",
+        "modules": [{"name": "app", "sources": [{"type": "git", "url": URL, "branch": "master"}]}],
+    }
+    return Manifest(data, "master")
+
+
+def test_pinned_git_source_has_no_branch():
+    manifest = create_manifest()
+    source = next(manifest.git_sources())
+    manifest.pin_git_source(source, "a" * 40)
+
+    assert source == {"type": "git", "url": URL, "commit": "a" * 40}
+    assert list(manifest.upstream_git_sources()) == [{"type": "git", "url": URL, "branch": "master"}]
+
+
+def test_fingerprint_resolves_pinned_git_sources_upstream(monkeypatch):
+    heads = {"master": "b" * 40}
+
+    async def fake_git_head(source: dict) -> str:
+        return source.get("commit") or heads[source["branch"]]
+
+    monkeypatch.setattr(fingerprint, "get_git_head", fake_git_head)
+    manifest = create_manifest()
+    manifest.pin_git_source(next(manifest.git_sources()), "a" * 40)
+
+    before = asyncio.run(compute_fingerprint(manifest, Path()))
+    heads["master"] = "c" * 40
+    assert asyncio.run(compute_fingerprint(manifest, Path())) != before
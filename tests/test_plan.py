@@ -0,0 +1,65 @@
+# Copyright 2019-2020 Jiří Janoušek <janousek.jiri@gmail.com>
+# License: BSD-2-Clause, see file LICENSE at the project root.
+"""
+Tests of planning builds.
+"""
+import asyncio
+import json
+import shutil
+from pathlib import Path
+
+from nufb import builder, fingerprint
+from nufb.builder import APP_MANIFEST, BuildSession, get_app_subst, plan_all
+from nufb.git import get_git_url
+
+ROOT = Path(__file__).resolve().parent.parent
+
+
+async def fake_git_head(source: dict) -> str:
+    return source.get("commit", "0" * 40)
+
+
+async def fake_installed_commit(ref: str) -> str:
+    return "1" * 40
+
+
+async def fake_exported_commit(*args) -> str:
+    return "2" * 40
+
+
+async def fake_step(*args, **kwargs) -> bool:
+    return True
+
+
+def test_freshly_built_manifest_plans_as_up_to_date(tmp_path, monkeypatch):
+    monkeypatch.setenv("XDG_CACHE_HOME", str(tmp_path / "cache"))
+    monkeypatch.chdir(ROOT)
+    monkeypatch.setattr(fingerprint, "get_git_head", fake_git_head)
+    monkeypatch.setattr(fingerprint, "get_installed_commit", fake_installed_commit)
+    monkeypatch.setattr(builder, "get_exported_commit", fake_exported_commit)
+    for step in "set_up", "copy_resources", "build_flatpak", "export_flatpak":
+        monkeypatch.setattr(builder.Builder, step, fake_step)
+
+    # Some resources are not part of the repository.
+    resources_dir = tmp_path / "resources"
+    shutil.copytree(ROOT / "resources", resources_dir)
+    for name in "nuvola-branding.json", "nuvola.appdata.xml":
+        if not (resources_dir / name).exists():
+            (resources_dir / name).write_text("{}")
+
+    async def build_and_plan():
+        session = await BuildSession.create(build_root=tmp_path / "build", resources_dir=resources_dir)
+        subst = get_app_subst("deezer")
+        manifest = await session.load_manifest(APP_MANIFEST, "master", subst)
+        git_commits = {get_git_url(source): "3" * 40 for source in manifest.git_sources()}
+        session.build_root.mkdir(parents=True)
+        (session.build_root / "app-commits.json").write_text(json.dumps({"master": {"deezer": git_commits}}))
+
+        await session.build_now("eu.tiliado.NuvolaBase", "master")
+        await session.build_now(APP_MANIFEST, "master", subst, git_commits=git_commits)
+        return await plan_all(session, "master", pin_commits=True)
+
+    plan = {build.name: build for build in asyncio.run(build_and_plan())}
+    assert plan["eu.tiliado.NuvolaBase//master"].up_to_date
+    assert plan["eu.tiliado.NuvolaAppDeezer//master"].up_to_date
+    assert not plan["eu.tiliado.NuvolaCdk//master"].up_to_date
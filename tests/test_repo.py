@@ -0,0 +1,72 @@
+# Copyright 2019-2020 Jiří Janoušek <janousek.jiri@gmail.com>
+# License: BSD-2-Clause, see file LICENSE at the project root.
+"""
+Tests of the repository.
+"""
+import asyncio
+import shutil
+import subprocess
+from typing import List
+
+import pytest
+
+from nufb.repo import parse_commit_tree, read_commit_tree
+
+CONTENTS = bytes(range(32))
+METADATA = bytes(range(32, 64))
+
+
+def serialize_commit(subject: str, body: str, metadata: bytes = b"") -> bytes:
+    """Serialize a commit `(a{sv}aya(say)sstayay)` with framing offsets of variable-size members in reverse order."""
+    data = bytearray(metadata)
+    ends: List[int] = [len(data)]
+    data += bytes(range(64, 96))  # parent
+    ends.append(len(data))
+    ends.append(len(data))  # no related objects
+    for text in subject, body:
+        data += text.encode() + b"\0"
+        ends.append(len(data))
+    data += bytes(-len(data) % 8) + (1600000000).to_bytes(8, "big")
+    data += CONTENTS
+    ends.append(len(data))
+    data += METADATA
+
+    offset_size = 1
+    while len(data) + 6 * offset_size > 256**offset_size - 1:
+        offset_size *= 2
+    return bytes(data) + b"".join(end.to_bytes(offset_size, "little") for end in reversed(ends))
+
+
+@pytest.mark.parametrize("body", ["", "Body", "x" * 300, "x" * 70000])
+def test_parse_commit_tree(body):
+    assert parse_commit_tree(serialize_commit("Export eu.tiliado.Nuvola", body, b"\1" * 13)) == (CONTENTS, METADATA)
+
+
+@pytest.mark.parametrize("data", [b"", b"\0" * 5, serialize_commit("Subject", "Body")[:-1], b"\xff" * 100])
+def test_parse_commit_tree_rejects_corrupted_commit(data):
+    with pytest.raises(ValueError):
+        parse_commit_tree(data)
+
+
+@pytest.mark.skipif(not shutil.which("ostree"), reason="ostree is not installed")
+def test_read_commit_tree_of_real_commit(tmp_path):
+    repo = tmp_path / "repo"
+    tree = tmp_path / "tree"
+    (tree / "files").mkdir(parents=True)
+    (tree / "files" / "hello.txt").write_text("Hello\n")
+    subprocess.run(["ostree", "init", "--mode=archive-z2", f"--repo={repo}"], check=True)
+    commit = subprocess.run(
+        ["ostree", "commit", f"--repo={repo}", "--branch=app/test", "--subject=Test", str(tree)],
+        check=True,
+        stdout=subprocess.PIPE,
+        universal_newlines=True,
+    ).stdout.strip()
+    listing = subprocess.run(
+        ["ostree", "ls", f"--repo={repo}", "-C", "-d", commit, "/"],
+        check=True,
+        stdout=subprocess.PIPE,
+        universal_newlines=True,
+    ).stdout.split()
+
+    contents, metadata = asyncio.run(read_commit_tree(repo, commit))
+    assert (contents.hex(), metadata.hex()) == tuple(listing[-3:-1])
@@ -0,0 +1,63 @@
+# Copyright 2019-2020 Jiří Janoušek <janousek.jiri@gmail.com>
+# License: BSD-2-Clause, see file LICENSE at the project root.
+"""
+Tests of scheduling of dependent builds.
+"""
+import asyncio
+from typing import List
+
+import pytest
+
+from nufb.manifest import Manifest
+from nufb.scheduler import BuildGraph, BuildNode
+
+
+def create_node(started: List[str], flatpak_id: str, weight: float, base: str = None, fail: bool = False) -> BuildNode:
+    data = {"app-id": flatpak_id}
+    if base:
+        data["base"] = base
+
+    async def run() -> None:
+        started.append(flatpak_id)
+        await asyncio.sleep(0)
+        if fail:
+            raise ValueError(flatpak_id)
+
+    return BuildNode(Manifest(data, "master"), run, weight)
+
+
+def test_ready_builds_start_in_order_of_critical_path():
+    started: List[str] = []
+    graph = BuildGraph()
+    graph.add(create_node(started, "short", 5.0))
+    graph.add(create_node(started, "base", 1.0))
+    graph.add(create_node(started, "app", 10.0, base="base"))
+
+    asyncio.run(graph.run(concurrency=1))
+
+    assert started == ["base", "app", "short"]
+    assert graph.nodes["base", "master"].priority == 11.0
+
+
+def test_dependents_of_failed_build_are_skipped():
+    started: List[str] = []
+    graph = BuildGraph()
+    graph.add(create_node(started, "base", 1.0, fail=True))
+    graph.add(create_node(started, "app", 1.0, base="base"))
+    graph.add(create_node(started, "addon", 1.0, base="app"))
+    graph.add(create_node(started, "other", 1.0))
+
+    with pytest.raises(ValueError, match="base"):
+        asyncio.run(graph.run(concurrency=2))
+
+    assert sorted(started) == ["base", "other"]
+
+
+def test_dependency_cycle_is_rejected():
+    started: List[str] = []
+    graph = BuildGraph()
+    graph.add(create_node(started, "one", 1.0, base="two"))
+    graph.add(create_node(started, "two", 1.0, base="one"))
+
+    with pytest.raises(ValueError, match="cycle"):
+        graph.link()
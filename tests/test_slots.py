@@ -0,0 +1,55 @@
+# Copyright 2019-2020 Jiří Janoušek <janousek.jiri@gmail.com>
+# License: BSD-2-Clause, see file LICENSE at the project root.
+"""
+Tests of build slots.
+"""
+import asyncio
+from typing import List
+
+from nufb.slots import BuildSlots
+
+GIB = 1 << 30
+
+
+def test_budgets_are_capped_to_capacity():
+    slots = BuildSlots(4, 8 * GIB, {"*Cdk": (16, 64 * GIB), "*App*": (0, GIB), "*Base": (2, GIB)})
+
+    assert slots.get_budget("eu.tiliado.NuvolaCdk") == (4, 8 * GIB)
+    assert slots.get_budget("eu.tiliado.NuvolaAppDeezer") == (4, GIB)
+    assert slots.get_budget("eu.tiliado.NuvolaBase") == (2, GIB)
+    assert slots.get_budget("eu.tiliado.Nuvola") == (4, 0)
+
+
+def test_slots_are_admitted_in_order():
+    acquired: List[str] = []
+
+    async def build(slots: BuildSlots, name: str, release: asyncio.Event) -> None:
+        async with slots.acquire(name):
+            acquired.append(name)
+            await release.wait()
+
+    async def run() -> None:
+        slots = BuildSlots(4, 8 * GIB, {"big": (4, GIB), "small*": (1, GIB)})
+        releases = {name: asyncio.Event() for name in ("small1", "big", "small2")}
+        tasks = []
+        for name, release in releases.items():
+            tasks.append(asyncio.ensure_future(build(slots, name, release)))
+            await asyncio.sleep(0.01)
+
+        # The second small build would fit, but it must not overtake the big one.
+        assert acquired == ["small1"]
+        assert (slots.free_cpus, slots.free_memory) == (3, 7 * GIB)
+
+        releases["small1"].set()
+        await asyncio.sleep(0.01)
+        assert acquired == ["small1", "big"]
+
+        releases["big"].set()
+        await asyncio.sleep(0.01)
+        assert acquired == ["small1", "big", "small2"]
+
+        releases["small2"].set()
+        await asyncio.gather(*tasks)
+        assert (slots.free_cpus, slots.free_memory) == (4, 8 * GIB)
+
+    asyncio.run(run())
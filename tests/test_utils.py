@@ -0,0 +1,13 @@
+# Copyright 2019-2020 Jiří Janoušek <janousek.jiri@gmail.com>
+# License: BSD-2-Clause, see file LICENSE at the project root.
+"""
+Tests of utility functions.
+"""
+import pytest
+
+from nufb import utils
+
+
+def test_yaml_loader_uses_libyaml_if_available():
+    pytest.importorskip("_ruamel_yaml")
+    assert utils.YAML_LIBYAML